@@ -0,0 +1,468 @@
+"""
+Offline benchmark of MessageService.process_dialogs.
+
+Telegram, the LLM API and Google Calendar are replaced by fakes: a client
+generating dialogs x messages, a local OpenAI-compatible HTTP stub with
+configurable latency and hit rate, and a calendar that only sleeps. The real
+TextAnalyzer, batching, serialization, dedup, reporting and SQLite code run
+unchanged, so the numbers show regressions in the pipeline itself.
+
+    python benchmark.py --dialogs 10 100 1000 --messages 100000
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from telethon.tl.types import PeerChannel
+
+from model.dialog import Dialog
+from model.dialogType import DialogType
+from model.envLoader import EnvLoader
+from service.calendarService import CalendarWriteResult
+from service.dbService import DBService
+from service.messageService import MessageService
+from service.runMetrics import RunMetrics
+from service.sentMessageIndex import SentMessageIndex
+from service.textAnalyzer import TextAnalyzer
+
+# GetHistory returns at most 100 messages per request
+FETCH_PAGE_SIZE = 100
+# Characters per streamed completion chunk
+STREAM_PIECE_CHARS = 64
+WORDS = (
+    "concierto mañana plaza entrada libre taller sábado charla mercado vecinos "
+    "reunión feria música teatro cine exposición barrio parque domingo noche"
+).split()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile, 0 for no values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+class FakeChannel:
+    def __init__(self, id, title):
+        self.id = id
+        self.title = title
+        self.username = None
+        self.has_link = False
+
+
+class FakeMessage:
+    def __init__(self, chat, id, text, date):
+        self.chat = chat
+        self.chat_id = chat.id
+        self.peer_id = PeerChannel(chat.id)
+        self.id = id
+        self.text = text
+        self.message = text
+        self.date = date
+        self.media = None
+        self.action = None
+
+
+class FakeTelegramClient:
+    """
+    Serves messages_per_dialog generated messages per channel, one page of
+    FETCH_PAGE_SIZE per fetch_latency, and accepts sends and forwards.
+    """
+
+    def __init__(self, messages_per_dialog, fetch_latency=0.02, send_latency=0.02, seed=0):
+        self.messages_per_dialog = messages_per_dialog
+        self.fetch_latency = fetch_latency
+        self.send_latency = send_latency
+        self.seed = seed
+        self.now = datetime.now(timezone.utc)
+        # Spread every dialog's messages over the last 23 hours
+        self.spacing = timedelta(hours=23) / max(messages_per_dialog, 1)
+        self.fetch_latencies = []
+        self.sent = 0
+        self.forwarded = 0
+        self.first_forward_at = None
+
+    def message_text(self, chat_id, message_id):
+        rng = random.Random(f"{self.seed}:{chat_id}:{message_id}")
+        return f"{' '.join(rng.choices(WORDS, k=rng.randint(4, 24)))} {chat_id}x{message_id}"
+
+    async def iter_messages(self, peer, min_id=0, offset_id=0, **kwargs):
+        chat_id = peer.channel_id
+        chat = FakeChannel(chat_id, f"Channel {chat_id}")
+        started = time.monotonic()
+        served = 0
+        try:
+            for message_id in range(self.messages_per_dialog, 0, -1):
+                if offset_id and message_id >= offset_id:
+                    continue
+                if message_id <= min_id:
+                    return
+                if served % FETCH_PAGE_SIZE == 0:
+                    await asyncio.sleep(self.fetch_latency)
+                served += 1
+                date = self.now - self.spacing * (self.messages_per_dialog - message_id + 1)
+                yield FakeMessage(chat, message_id, self.message_text(chat_id, message_id), date)
+        finally:
+            self.fetch_latencies.append(time.monotonic() - started)
+
+    async def send_message(self, peer, text, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+
+    async def forward_messages(self, peer, messages, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.forwarded += len(messages)
+        if self.first_forward_at is None:
+            self.first_forward_at = time.monotonic()
+        return messages
+
+
+class FakeCalendarService:
+    def __init__(self, latency=0.15):
+        self.latency = latency
+        self.write_latencies = []
+        self.created = 0
+
+    def event_id_for(self, dialog_id, message_id):
+        return f"fake{dialog_id}x{message_id}"
+
+    async def create_events_async(self, events):
+        if not events:
+            return []
+        started = time.monotonic()
+        await asyncio.sleep(self.latency)
+        results = []
+        for _ in events:
+            self.created += 1
+            results.append(CalendarWriteResult(google_event_id=f"fake{self.created}"))
+        self.write_latencies.append(time.monotonic() - started)
+        return results
+
+    async def delete_events_async(self, google_event_ids):
+        await asyncio.sleep(self.latency)
+        return [CalendarWriteResult(google_event_id=google_event_id) for google_event_id in google_event_ids]
+
+
+class StubLLMServer:
+    """
+    OpenAI-compatible /chat/completions endpoint on localhost. Each request
+    sleeps latency +- jitter seconds; a message is reported as found with
+    probability hit_rate, and a found message also yields an event with
+    probability event_rate. Choices are seeded by message id, so every run
+    returns the same answers.
+    """
+
+    COMPACT_ROW = re.compile(r"^(\d+)\|\d+\|")
+    LEGACY_OBJECT = re.compile(r"'chat_id': (-?\d+), 'text': .*?'message_id': (\d+)")
+
+    def __init__(self, latency=0.3, jitter=0.1, hit_rate=0.01, event_rate=0.3, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.hit_rate = hit_rate
+        self.event_rate = event_rate
+        self.seed = seed
+        # System prompts seen so far, reported back as cached like a provider's prompt cache
+        self.seen_prefixes = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def message_ids(self, content):
+        if content.startswith("Messages as"):
+            chat_id = None
+            for line in content.split("\n")[1:]:
+                if line.startswith("# chat "):
+                    chat_id = line[len("# chat "):].split("|", 1)[0]
+                    continue
+                match = self.COMPACT_ROW.match(line)
+                if match:
+                    yield chat_id, match.group(1)
+        else:
+            for match in self.LEGACY_OBJECT.finditer(content):
+                yield match.group(1), match.group(2)
+
+    def answer(self, content):
+        results = []
+        events = []
+        tomorrow = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) + timedelta(days=1)
+        for chat_id, message_id in self.message_ids(content):
+            rng = random.Random(f"{self.seed}:{chat_id}:{message_id}")
+            if rng.random() >= self.hit_rate:
+                continue
+            results.append({"chat_id": chat_id, "message_id": message_id, "text": ""})
+            if rng.random() < self.event_rate:
+                start = tomorrow + timedelta(hours=rng.randint(0, 72))
+                events.append({
+                    "chat_id": chat_id,
+                    "message_id": message_id,
+                    "start_datetime": start.isoformat(),
+                    "end_datetime": (start + timedelta(hours=2)).isoformat(),
+                    "title": " ".join(rng.sample(WORDS, 3)).capitalize(),
+                    "description": "Generated by the benchmark stub",
+                })
+        return {"found": bool(results), "results": results, "Events": events}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                content = request["messages"][-1]["content"]
+                system = request["messages"][0]["content"]
+                if isinstance(system, list):
+                    system = "".join(part["text"] for part in system)
+                cached_tokens = len(system) // 4 if system in stub.seen_prefixes else 0
+                stub.seen_prefixes.add(system)
+                latency = max(0.0, stub.latency + random.uniform(-stub.jitter, stub.jitter))
+                answer = json.dumps(stub.answer(content))
+                usage = {
+                    "prompt_tokens": (len(system) + len(content)) // 4,
+                    "completion_tokens": len(answer) // 4,
+                    "total_tokens": (len(system) + len(content) + len(answer)) // 4,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                }
+                if request.get("stream"):
+                    self.stream(request, answer, usage, latency)
+                    return
+                time.sleep(latency)
+                body = json.dumps({
+                    "id": "stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": answer},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def stream(self, request, answer, usage, latency):
+                """
+                Server-sent events: the first piece after a third of the
+                latency, the rest of the answer spread over the remainder.
+                """
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                pieces = [answer[start:start + STREAM_PIECE_CHARS] for start in range(0, len(answer), STREAM_PIECE_CHARS)]
+                time.sleep(latency / 3)
+                for piece in pieces:
+                    self.send_event({
+                        "id": "stub",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": request.get("model", "stub"),
+                        "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+                    })
+                    time.sleep(latency * 2 / 3 / len(pieces))
+                self.send_event({
+                    "id": "stub",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "choices": [],
+                    "usage": usage,
+                })
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def send_event(self, data):
+                self.wfile.write(b"data: " + json.dumps(data).encode("utf-8") + b"\n\n")
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class BenchmarkEnv(EnvLoader):
+    """
+    Tuning comes from the environment as usual; only the ids and report rate
+    are pinned so the fakes are never throttled like the real API.
+    """
+
+    @property
+    def error_dialog_id(self):
+        return 1
+
+    @property
+    def output_dialog_id(self):
+        return 2
+
+    @property
+    def report_requests_per_second(self):
+        return 1000.0
+
+    @property
+    def lookback_hours(self):
+        return 24
+
+
+async def run_scenario(args, server, dialog_count, db_path):
+    env = BenchmarkEnv()
+    metrics = RunMetrics()
+    client = FakeTelegramClient(
+        max(1, args.messages // dialog_count), args.fetch_latency_ms / 1000, args.send_latency_ms / 1000, args.seed
+    )
+    calendar_service = FakeCalendarService(args.calendar_latency_ms / 1000)
+    text_analyzer = TextAnalyzer("stub", "Find the relevant messages.", "stub", env.llm_concurrency,
+                                 metrics=metrics, base_url=server.base_url, streaming=args.streaming)
+    llm_latencies = []
+    find_messages = text_analyzer.findMessages
+
+    async def timed_find_messages(text, on_item=None):
+        started = time.monotonic()
+        try:
+            return await find_messages(text, on_item)
+        finally:
+            llm_latencies.append(time.monotonic() - started)
+
+    text_analyzer.findMessages = timed_find_messages
+    db_service = DBService(db_path)
+    message_service = MessageService(
+        client=client,
+        db_service=db_service,
+        text_analyzer=text_analyzer,
+        calendar_service=calendar_service,
+        env=env,
+        metrics=metrics,
+    )
+    dialogs = [Dialog(1000 + index, DialogType.CHANNEL) for index in range(dialog_count)]
+
+    tracemalloc.start()
+    started = time.monotonic()
+    try:
+        # The analyzer and dedup print every hit; keep the report readable
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            processed, found, events = await message_service.process_dialogs(
+                dialogs, SentMessageIndex(db_service, env.sent_messages_retention_days)
+            )
+        elapsed = time.monotonic() - started
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        await text_analyzer.close()
+        db_service.close()
+
+    def latency_summary(values):
+        return {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "max_ms": round(max(values, default=0) * 1000, 1),
+        }
+
+    return {
+        "dialogs": dialog_count,
+        "messages": processed,
+        "found": found,
+        "events": events,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(processed / elapsed, 1) if elapsed else 0.0,
+        "fetch_dialog": latency_summary(client.fetch_latencies),
+        "llm_chunk": latency_summary(llm_latencies),
+        "calendar_write": latency_summary(calendar_service.write_latencies),
+        "forwarded": client.forwarded,
+        "first_report_ms": round((client.first_forward_at - started) * 1000, 1) if client.first_forward_at else None,
+        "prompt_tokens": metrics.total("llm_prompt_tokens"),
+        "cached_prompt_tokens": metrics.total("llm_cached_prompt_tokens"),
+        "serialized_bytes": metrics.total("serialized_bytes"),
+        "peak_traced_mib": round(peak_memory / 2 ** 20, 1),
+    }
+
+
+def print_result(result):
+    print(
+        f"{result['dialogs']:>5} dialogs {result['messages']:>7} messages  "
+        f"{result['seconds']:>7.2f}s  {result['messages_per_second']:>9.1f} msg/s  "
+        f"peak {result['peak_traced_mib']:>7.1f} MiB  found {result['found']}, events {result['events']}"
+    )
+    if result["first_report_ms"] is not None:
+        print(f"      first report after {result['first_report_ms']:.1f} ms")
+    for stage in ("fetch_dialog", "llm_chunk", "calendar_write"):
+        latency = result[stage]
+        print(
+            f"      {stage:<15} n={latency['count']:<6} p50 {latency['p50_ms']:>8.1f} ms  "
+            f"p95 {latency['p95_ms']:>8.1f} ms  p99 {latency['p99_ms']:>8.1f} ms  max {latency['max_ms']:>8.1f} ms"
+        )
+
+
+async def run_benchmark(args):
+    server = StubLLMServer(
+        args.llm_latency_ms / 1000, args.llm_jitter_ms / 1000, args.hit_rate, args.event_rate, args.seed
+    )
+    server.start()
+    results = []
+    try:
+        for dialog_count in args.dialogs:
+            with tempfile.TemporaryDirectory() as directory:
+                result = await run_scenario(args, server, dialog_count, os.path.join(directory, "benchmark.db"))
+            print_result(result)
+            results.append(result)
+    finally:
+        server.stop()
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_mib = max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+    print(f"Process max RSS: {max_rss_mib:.1f} MiB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"arguments": vars(args), "results": results, "max_rss_mib": round(max_rss_mib, 1)}, f, indent=2)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the message pipeline")
+    parser.add_argument("--dialogs", type=int, nargs="+", default=[10, 100, 1000], help="dialog counts to run")
+    parser.add_argument("--messages", type=int, default=100000, help="messages per run, split across the dialogs")
+    parser.add_argument("--llm-latency-ms", type=float, default=300)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100)
+    parser.add_argument("--hit-rate", type=float, default=0.01, help="share of messages the stub reports as found")
+    parser.add_argument("--event-rate", type=float, default=0.3, help="share of found messages that carry an event")
+    parser.add_argument("--fetch-latency-ms", type=float, default=20, help="per page of 100 messages")
+    parser.add_argument("--send-latency-ms", type=float, default=20)
+    parser.add_argument("--calendar-latency-ms", type=float, default=150, help="per batched calendar write")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--streaming", action="store_true", help="stream completions, as LLM_STREAMING=true does")
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_benchmark(parse_arguments()))
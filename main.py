@@ -1,47 +1,190 @@
-from telethon import TelegramClient
+import time
+# Measured from here so the summary can show how long imports took
+imports_started_at = time.perf_counter()
+
+from telethon import TelegramClient, events
+from telethon.utils import get_peer_id
 from model.envLoader import EnvLoader
 from service.textAnalyzer import TextAnalyzer
+from service.llmCache import LLMCache
+from service.sentMessageIndex import SentMessageIndex
 from service.calendarService import CalendarService
-from telethon.tl import functions
 from service.dbService import DBService
-from telethon.tl.types import PeerChannel, InputPeerChannel, InputPeerChat, InputPeerUser
+from telethon.tl.types import PeerChannel
 from datetime import datetime, timedelta
-from service.util import Util
-from tenacity import retry, stop_after_attempt, wait_fixed
-from model.dialog import Dialog
-from model.dialogType import DialogType
 from service.messageService import MessageService
+from service.microBatcher import MicroBatcher
+from service.runMetrics import RunMetrics
+from service.shardRunner import ShardRunner
+from service.entityCache import EntityCache
+from service.dialogFilterCache import DialogFilterCache
+from service.shardRunner import keep_leases
+import argparse
+import asyncio
+import os
+import signal
+import socket
+
+imports_seconds = time.perf_counter() - imports_started_at
+
+
+async def run_daemon(env, client, message_service, dialog_filter_cache, target_dialog_objects, sent_messages):
+    """
+    Keeps the client connected and analyzes new messages of the target dialogs
+    in micro-batches instead of re-fetching history on every run.
+    """
+    dialogs_by_peer_id = {get_peer_id(d.peer): d for d in target_dialog_objects}
+    # One queue for the whole run, so reports of later batches are scheduled
+    # after those still waiting in the output channel
+    report_queue = message_service.create_report_queue()
+
+    async def on_filter_change(dialog_objects):
+        # New dialogs are picked up from their next message; their history is
+        # fetched on the next start
+        await message_service.entity_cache.load(dialog_objects)
+        dialogs_by_peer_id.clear()
+        dialogs_by_peer_id.update({get_peer_id(d.peer): d for d in dialog_objects})
+        print(f"Dialog filter changed: now watching {len(dialogs_by_peer_id)} dialogs")
+
+    async def process_batches(dialog_batches):
+        failed_batches = []
+        try:
+            processed, messages_found, events_found = await message_service.process_messages(
+                dialog_batches, sent_messages, report_queue, failed_batches
+            )
+            print(f"Live batch: processed {processed}, found {messages_found}, events {events_found}")
+        except Exception as e:
+            # Redoing what was committed is harmless, see MessageService.handle_chunk
+            failed_batches = dialog_batches
+            await client.send_message(
+                PeerChannel(env.error_dialog_id),
+                f'Error processing live messages.\nError: {e}'
+            )
+        # Retried with the next batch; until then, or after shutting down, the
+        # dialogs' checkpoints stay before them
+        micro_batcher.retry(failed_batches)
+
+    micro_batcher = MicroBatcher(
+        process_batches, env.live_batch_size, env.live_batch_seconds, message_service.message_object
+    )
+
+    async def on_new_message(event):
+        dialog_object = dialogs_by_peer_id.get(event.chat_id)
+        if dialog_object is None:
+            return
+        # Titles and links come from the entity cache, so there is no get_chat() round-trip
+        await micro_batcher.add(dialog_object, event.message)
+
+    # Not limited with chats=, so dialogs added to the filter while running are seen
+    client.add_event_handler(on_new_message, events.NewMessage())
+    dialog_filter_cache.watch(on_filter_change)
+
+    async def shut_down():
+        # Flushed while still connected, so forwards and error reports go out;
+        # after an unexpected disconnect, the next start catches up instead
+        await micro_batcher.close()
+        await client.disconnect()
+
+    shutdown_tasks = []
+    loop = asyncio.get_running_loop()
+    for shutdown_signal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(shutdown_signal, lambda: shutdown_tasks.append(asyncio.create_task(shut_down())))
+
+    # Catch up on whatever arrived since the last run before going live; live
+    # batches wait meanwhile, as each join() of the shared queue must only see
+    # failures of its own reports
+    async with micro_batcher.flush_lock:
+        await message_service.process_dialogs(target_dialog_objects, sent_messages, report_queue)
+    await client.run_until_disconnected()
 
-env = EnvLoader()
-client = TelegramClient('main', env.telegram_api_id, env.telegram_api_hash)
 
+async def run_shards(env, client, message_service, llm_cache, metrics, target_dialog_objects, workers):
+    """
+    Processes the target dialogs in worker processes and folds the worker
+    summaries into this process' counters, so the final summary covers all shards.
+    """
+    processed, messages_found, events_found = 0, 0, 0
+    weighted_tokens = 0.0
+    # Commit what the main client has cached in its session before workers copy it
+    client.session.save()
+    for shard in await ShardRunner(workers).run(target_dialog_objects):
+        if "error" in shard:
+            await client.send_message(
+                PeerChannel(env.error_dialog_id),
+                f'Error in worker for shard {shard["shard"]}.\nError: {shard["error"]}'
+            )
+            continue
+        print(
+            f"Shard {shard['shard']}: {shard['dialogs']} dialogs ({shard['skipped_dialogs']} leased elsewhere), "
+            f"processed {shard['processed']}, found {shard['found']}, events {shard['events']}"
+        )
+        processed += shard["processed"]
+        messages_found += shard["found"]
+        events_found += shard["events"]
+        if "metrics" not in shard:
+            continue
+        weighted_tokens += shard["tokens_per_message"] * shard["processed"]
+        message_service.message_pre_filter.dropped.update(shard["pre_filter_dropped"])
+        message_service.message_pre_filter.dropped_tokens += shard["pre_filter_dropped_tokens"]
+        llm_cache.hits += shard["llm_cache_hits"]
+        llm_cache.misses += shard["llm_cache_misses"]
+        metrics.merge_record(shard["metrics"])
+    if processed:
+        message_service.tokens_per_message = weighted_tokens / processed
+    return processed, messages_found, events_found
+
+
+async def process_leased_dialogs(env, message_service, db_service, dialog_objects, sent_messages):
+    """
+    Processes the target dialogs in this process under the same leases as
+    worker processes, so dialogs held by an overlapping run are skipped.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    leased = db_service.acquire_dialog_leases(owner, [d.id for d in dialog_objects], env.shard_lease_seconds)
+    leased_dialog_objects = [d for d in dialog_objects if str(d.id) in leased]
+    if len(leased_dialog_objects) < len(dialog_objects):
+        print(f"Skipping {len(dialog_objects) - len(leased_dialog_objects)} dialogs leased elsewhere")
+    heartbeat = asyncio.create_task(keep_leases(db_service, owner, env.shard_lease_seconds))
+    try:
+        return await message_service.process_dialogs(leased_dialog_objects, sent_messages)
+    finally:
+        heartbeat.cancel()
+        db_service.release_dialog_leases(owner)
 
-@retry(stop=stop_after_attempt(5), wait=wait_fixed(10))
-async def get_dialog_filters_with_retry(client):
-    return await client(functions.messages.GetDialogFiltersRequest())
 
-def build_dialog_object(peer):
-    if type(peer) == InputPeerChannel:
-        return Dialog(peer.channel_id, DialogType.CHANNEL)
-    elif type(peer) == InputPeerChat:
-        return Dialog(peer.chat_id, DialogType.CHAT)
-    elif type(peer) == InputPeerUser:
-        return Dialog(peer.user_id, DialogType.USER)
+def startup_breakdown(metrics):
+    stages = ["imports", "client_start", "calendar_init", "dialog_filters", "entity_cache", "llm_client_init", "calendar_build"]
+    return ", ".join(f"{stage} {metrics.stage_seconds(stage):.2f}s" for stage in stages)
+
+
+def write_metrics(env, metrics, **summary):
+    metrics.observe("run", time.time() - metrics.started_at)
+    try:
+        if env.metrics_textfile:
+            metrics.write_textfile(env.metrics_textfile)
+        if env.metrics_run_record:
+            metrics.append_record(env.metrics_run_record, **summary)
+    except OSError as e:
+        print(f"Error writing metrics: {e}")
 
-def get_target_dialog_objects(filters, env):
-    for dialog_filter in filters:
-        if hasattr(dialog_filter, 'id') and dialog_filter.title == env.target_dialog_filter:
-            return list(map(lambda peer: build_dialog_object(peer), dialog_filter.include_peers))
-    return []
 
-async def main():
-    text_analyzer = TextAnalyzer(env.openrouter_api_key, env.base_prompt, env.llm_model)
-    await client.start()
+async def main(env, client, daemon=False, workers=1):
+    metrics = RunMetrics()
+    metrics.observe("imports", imports_seconds)
+    llm_cache = LLMCache(ttl_hours=env.llm_cache_ttl_hours, max_entries=env.llm_cache_max_entries)
+    text_analyzer = TextAnalyzer(
+        env.openrouter_api_key, env.base_prompt, env.llm_model, env.llm_concurrency, llm_cache, metrics,
+        streaming=env.llm_streaming,
+    )
+    with metrics.time("client_start"):
+        await client.start()
     db_service = DBService()
-    sent_messages = []
+    sent_messages = SentMessageIndex(db_service, env.sent_messages_retention_days)
 
     try:
-        calendar_service = CalendarService(env.calendar_id)
+        with metrics.time("calendar_init"):
+            calendar_service = CalendarService(env.calendar_id, metrics=metrics)
+            calendar_service.check_credentials()
     except Exception as e:
         await client.send_message(
             PeerChannel(env.error_dialog_id),
@@ -53,16 +196,24 @@ async def main():
         print(f"Error initializing services: {e}")
         return
 
+    entity_cache = EntityCache(db_service, client, env.entity_refresh_hours)
     message_service = MessageService(
         client=client,
         db_service=db_service,
         text_analyzer=text_analyzer,
         calendar_service=calendar_service,
         env=env,
+        metrics=metrics,
+        entity_cache=entity_cache,
     )
 
-    filters = await get_dialog_filters_with_retry(client)
-    target_dialog_objects = get_target_dialog_objects(filters, env)
+    dialog_filter_cache = DialogFilterCache(
+        db_service, client, env.target_dialog_filter, env.dialog_filter_ttl_hours, metrics
+    )
+    with metrics.time("dialog_filters"):
+        target_dialog_objects = await dialog_filter_cache.target_dialogs()
+    with metrics.time("entity_cache"):
+        await entity_cache.load(target_dialog_objects)
 
     # Collect all peers from all target dialogs
     all_peers = []
@@ -74,17 +225,57 @@ async def main():
     total_events_found = 0
 
     # Process all messages from all dialogs at once
-    processed, messages_found, events_found = await message_service.process_dialogs(
-        all_peers, sent_messages
-    )
-    total_messages_processed += processed
-    total_messages_found += messages_found
-    total_events_found += events_found
+    try:
+        if daemon:
+            await run_daemon(env, client, message_service, dialog_filter_cache, all_peers, sent_messages)
+            return
+        dialog_filter_cache.watch()
+        with metrics.time("process_dialogs"):
+            if workers > 1:
+                processed, messages_found, events_found = await run_shards(
+                    env, client, message_service, llm_cache, metrics, all_peers, workers
+                )
+            else:
+                processed, messages_found, events_found = await process_leased_dialogs(
+                    env, message_service, db_service, all_peers, sent_messages
+                )
+        total_messages_processed += processed
+        total_messages_found += messages_found
+        total_events_found += events_found
+    finally:
+        await text_analyzer.close()
+        llm_cache.close()
+        db_service.close()
+        write_metrics(
+            env,
+            metrics,
+            messages_processed=total_messages_processed,
+            messages_found=total_messages_found,
+            events_found=total_events_found,
+        )
 
     await client.send_message(
         PeerChannel(env.error_dialog_id),
-        f'Execution completed.\nMessages processed: {total_messages_processed},\nMessages found: {total_messages_found},\nEvents found: {total_events_found}'
+        f'Execution completed.\nMessages processed: {total_messages_processed},\nMessages found: {total_messages_found},\nEvents found: {total_events_found},\nLLM cache: {llm_cache.stats()},\n'
+        f'Prompt tokens per message: {message_service.tokens_per_message:.1f},\n'
+        f'Pre-filter: {message_service.message_pre_filter.stats()},\n'
+        f'LLM tokens: {metrics.total("llm_prompt_tokens"):.0f} prompt ({metrics.total("llm_cached_prompt_tokens"):.0f} cached), '
+        f'{metrics.total("llm_completion_tokens"):.0f} completion, '
+        f'cost ${metrics.total("llm_cost_usd"):.4f}, retries: {metrics.total("retries"):.0f},\n'
+        f'Startup: {startup_breakdown(metrics)}'
     )
 
-with client:
-    client.loop.run_until_complete(main())
\ No newline at end of file
+# Worker processes are spawned and import this module again, so the client is
+# only created when executed
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Telegram message analyzer")
+    parser.add_argument("--daemon", action="store_true", help="stay connected and analyze new messages as they arrive")
+    parser.add_argument("--workers", type=int, default=1, help="split the dialogs over this many worker processes")
+    args = parser.parse_args()
+    if args.daemon and args.workers > 1:
+        parser.error("--daemon runs in a single process; --workers cannot be combined with it")
+
+    env = EnvLoader()
+    client = TelegramClient('main', env.telegram_api_id, env.telegram_api_hash)
+    with client:
+        client.loop.run_until_complete(main(env, client, daemon=args.daemon, workers=args.workers))
\ No newline at end of file
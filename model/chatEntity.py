@@ -0,0 +1,60 @@
+from typing import Optional
+from telethon.tl.types import Channel, Chat, User
+
+
+class ChatEntity():
+    """
+    The chat metadata links and prompts need, detached from Telethon entities
+    so it can be stored in messages.db and read without a network round-trip.
+    """
+    CHANNEL = "channel"
+    MEGAGROUP = "megagroup"
+    CHAT = "chat"
+    USER = "user"
+
+    def __init__(
+        self,
+        chat_id: int,
+        title: Optional[str] = None,
+        username: Optional[str] = None,
+        has_link: bool = False,
+        type: Optional[str] = None,
+    ):
+        self.chat_id = chat_id
+        self.title = title
+        self.username = username
+        self.has_link = has_link
+        self.type = type
+
+    @staticmethod
+    def from_entity(entity) -> "ChatEntity":
+        if isinstance(entity, Channel):
+            entity_type = ChatEntity.CHANNEL if entity.broadcast else ChatEntity.MEGAGROUP
+        elif isinstance(entity, Chat):
+            entity_type = ChatEntity.CHAT
+        elif isinstance(entity, User):
+            entity_type = ChatEntity.USER
+        else:
+            entity_type = None
+        title = getattr(entity, "title", None)
+        if title is None and entity_type == ChatEntity.USER:
+            title = " ".join(name for name in (entity.first_name, entity.last_name) if name) or None
+        return ChatEntity(
+            entity.id,
+            title,
+            getattr(entity, "username", None),
+            bool(getattr(entity, "has_link", False)),
+            entity_type,
+        )
+
+    def as_row(self):
+        return self.chat_id, self.title, self.username, self.has_link, self.type
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ChatEntity) and self.as_row() == other.as_row()
+
+    def __str__(self) -> str:
+        return f"ChatEntity(chat_id={self.chat_id}, title={self.title}, username={self.username}, has_link={self.has_link}, type={self.type})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
@@ -6,8 +6,10 @@ class Dialog():
     id: int
     peer: TypePeer
 
-    def __init__(self, id: int, peerType: DialogType):
+    def __init__(self, id: int, peerType: DialogType, input_peer=None):
         self.id = id
+        # InputPeer from the dialog filter, if known; it carries the access hash
+        self.input_peer = input_peer
         if peerType == DialogType.USER:
             self.peer = PeerUser(id)
         elif peerType == DialogType.CHAT:
@@ -57,3 +57,116 @@ class EnvLoader:
     @property
     def calendar_id(self):
         return self.get("CALENDAR_ID")
+
+    @property
+    def fetch_concurrency(self):
+        return int(self.get("FETCH_CONCURRENCY", 8))
+
+    @property
+    def llm_chunk_tokens(self):
+        return int(self.get("LLM_CHUNK_TOKENS", 30000))
+
+    @property
+    def llm_concurrency(self):
+        return int(self.get("LLM_CONCURRENCY", 4))
+
+    @property
+    def llm_streaming(self):
+        return self.get("LLM_STREAMING", "false").lower() in ("1", "true", "yes")
+
+    @property
+    def llm_cache_ttl_hours(self):
+        return int(self.get("LLM_CACHE_TTL_HOURS", 168))
+
+    @property
+    def llm_cache_max_entries(self):
+        return int(self.get("LLM_CACHE_MAX_ENTRIES", 5000))
+
+    @property
+    def dedup_similarity_threshold(self):
+        return float(self.get("DEDUP_SIMILARITY_THRESHOLD", 0.6))
+
+    @property
+    def dedup_containment(self):
+        return self.get("DEDUP_CONTAINMENT", "true").lower() in ("1", "true", "yes")
+
+    @property
+    def dedup_window_minutes(self):
+        return int(self.get("DEDUP_WINDOW_MINUTES", 120))
+
+    @property
+    def sent_messages_retention_days(self):
+        return int(self.get("SENT_MESSAGES_RETENTION_DAYS", 7))
+
+    @property
+    def lookback_hours(self):
+        return int(self.get("LOOKBACK_HOURS", 24))
+
+    @property
+    def prompt_format(self):
+        return self.get("PROMPT_FORMAT", "compact")
+
+    @property
+    def live_batch_size(self):
+        return int(self.get("LIVE_BATCH_SIZE", 50))
+
+    @property
+    def live_batch_seconds(self):
+        return float(self.get("LIVE_BATCH_SECONDS", 10))
+
+    @property
+    def shard_index(self):
+        # This process' share of the budgets below; see ShardEnv for worker processes
+        return 0
+
+    @property
+    def shard_count(self):
+        return 1
+
+    @property
+    def report_concurrency(self):
+        return int(self.get("REPORT_CONCURRENCY", 4))
+
+    @property
+    def report_requests_per_second(self):
+        return float(self.get("REPORT_REQUESTS_PER_SECOND", 1))
+
+    @property
+    def prefilter_min_letters(self):
+        return int(self.get("PREFILTER_MIN_LETTERS", 3))
+
+    @property
+    def prefilter_drop_media_only(self):
+        return self.get("PREFILTER_DROP_MEDIA_ONLY", "true").lower() in ("1", "true", "yes")
+
+    @property
+    def prefilter_deny_regex(self):
+        return self.get("PREFILTER_DENY_REGEX")
+
+    @property
+    def prefilter_allow_regex(self):
+        return self.get("PREFILTER_ALLOW_REGEX")
+
+    @property
+    def prefilter_chat_rules(self):
+        return self.get("PREFILTER_CHAT_RULES")
+
+    @property
+    def metrics_textfile(self):
+        return self.get("METRICS_TEXTFILE")
+
+    @property
+    def metrics_run_record(self):
+        return self.get("METRICS_RUN_RECORD")
+
+    @property
+    def shard_lease_seconds(self):
+        return int(self.get("SHARD_LEASE_SECONDS", 300))
+
+    @property
+    def entity_refresh_hours(self):
+        return int(self.get("ENTITY_REFRESH_HOURS", 24))
+
+    @property
+    def dialog_filter_ttl_hours(self):
+        return int(self.get("DIALOG_FILTER_TTL_HOURS", 24))
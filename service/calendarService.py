@@ -1,22 +1,93 @@
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+import asyncio
+import hashlib
+from typing import List, Optional
+
+from service.runMetrics import RunMetrics
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 CALENDAR_SUMMARY = "Event Calendar"
+# Google recommends at most 50 calls per batch request
+MAX_BATCH_SIZE = 50
+
+
+class CalendarWriteResult:
+    """
+    Outcome of one insert or delete sent in a batch request.
+    """
+
+    def __init__(self, google_event_id: Optional[str] = None, error: Optional[Exception] = None):
+        self.google_event_id = google_event_id
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __str__(self) -> str:
+        return f"CalendarWriteResult(google_event_id={self.google_event_id}, error={self.error})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
 
 class CalendarService:
-    def __init__(self, calendar_id, credentials_path="service_account_creds.json"):
+    """
+    The API client library is imported and the client is built on first use,
+    so runs that create no events never pay for them; check_credentials()
+    validates the credentials file up front. The client is built from the
+    discovery document bundled with google-api-python-client instead of
+    fetching it over the network.
+    """
+
+    def __init__(self, calendar_id, credentials_path="service_account_creds.json", metrics=None):
         self.credentials_path = credentials_path
+        self.metrics = metrics or RunMetrics()
         self.calendar_id = calendar_id
-        self.creds = self.authenticate()
-        self.service = build("calendar", "v3", credentials=self.creds)
+        self._creds = None
+        self._service = None
+        # The API client is not thread-safe; writes are queued on this lock and
+        # sent one batch at a time from a worker thread.
+        self.write_lock = asyncio.Lock()
 
     def authenticate(self):
+        from google.oauth2 import service_account
         creds = service_account.Credentials.from_service_account_file(self.credentials_path, scopes=SCOPES)
         return creds
-    
-    def create_event(self, name, description, start_datetime, end_datetime):
-        event = {
+
+    def check_credentials(self) -> None:
+        """
+        Loads the credentials now, so a missing or invalid file is reported
+        before any message is processed rather than once per event.
+        """
+        _ = self.creds
+
+    @property
+    def creds(self):
+        if self._creds is None:
+            self._creds = self.authenticate()
+        return self._creds
+
+    @property
+    def service(self):
+        if self._service is None:
+            with self.metrics.time("calendar_build"):
+                from googleapiclient.discovery import build
+                self._service = build(
+                    "calendar", "v3", credentials=self.creds, static_discovery=True, cache_discovery=False
+                )
+        return self._service
+
+    def event_id_for(self, dialog_id, message_id) -> str:
+        """
+        Deterministic Google event id of the event found in a message. Event ids
+        use base32hex characters, which hex digits are a subset of, so inserting
+        the same message's event twice fails with 409 instead of duplicating it.
+        """
+        return hashlib.sha1(f"{self.calendar_id}:{dialog_id}:{message_id}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def build_event_body(name, description, start_datetime, end_datetime, event_id=None):
+        body = {
             "summary": name,
             "description": description,
             "start": {
@@ -26,16 +97,94 @@ class CalendarService:
                 "dateTime": end_datetime.isoformat()
             },
         }
+        if event_id is not None:
+            body["id"] = event_id
+        return body
+
+    def create_event(self, name, description, start_datetime, end_datetime):
+        event = self.build_event_body(name, description, start_datetime, end_datetime)
         return self.service.events().insert(calendarId=self.calendar_id, body=event).execute()
 
+    def _execute_batches(self, requests, result_id, conflict_ok=False) -> List[CalendarWriteResult]:
+        """
+        Sends requests in batch requests of MAX_BATCH_SIZE calls and returns one
+        result per request, in order. result_id picks the google_event_id out of
+        a successful response. With conflict_ok, a 409 (the event id exists
+        already) counts as success and result_id gets a None response.
+        """
+        results = [None] * len(requests)
+        for start in range(0, len(requests), MAX_BATCH_SIZE):
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                if exception is not None and conflict_ok and getattr(getattr(exception, "resp", None), "status", None) == 409:
+                    results[index] = CalendarWriteResult(google_event_id=result_id(index, None))
+                elif exception is not None:
+                    results[index] = CalendarWriteResult(error=exception)
+                else:
+                    results[index] = CalendarWriteResult(google_event_id=result_id(index, response))
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for index in range(start, min(start + MAX_BATCH_SIZE, len(requests))):
+                batch.add(requests[index], request_id=str(index))
+            with self.metrics.time("calendar_batch"):
+                batch.execute()
+        self.metrics.increment("calendar_write_errors", sum(1 for result in results if not result.ok))
+        return results
+
+    def create_events(self, events: List[dict]) -> List[CalendarWriteResult]:
+        """
+        Inserts events (dicts with the build_event_body arguments) using batch
+        requests. Events given an event_id are idempotent: one that exists
+        already is reported as created.
+        """
+        bodies = [self.build_event_body(**event) for event in events]
+        requests = [self.service.events().insert(calendarId=self.calendar_id, body=body) for body in bodies]
+        return self._execute_batches(
+            requests,
+            lambda index, response: response.get('id') if response is not None else bodies[index].get('id'),
+            conflict_ok=True,
+        )
+
+    def delete_events(self, google_event_ids: List[str]) -> List[CalendarWriteResult]:
+        requests = [
+            self.service.events().delete(calendarId=self.calendar_id, eventId=google_event_id)
+            for google_event_id in google_event_ids
+        ]
+        return self._execute_batches(requests, lambda index, response: google_event_ids[index])
+
+    async def create_events_async(self, events: List[dict]) -> List[CalendarWriteResult]:
+        if not events:
+            return []
+        async with self.write_lock:
+            with self.metrics.time("calendar_write", operation="insert"):
+                return await asyncio.to_thread(self.create_events, events)
+
+    async def delete_events_async(self, google_event_ids: List[str]) -> List[CalendarWriteResult]:
+        if not google_event_ids:
+            return []
+        async with self.write_lock:
+            with self.metrics.time("calendar_write", operation="delete"):
+                return await asyncio.to_thread(self.delete_events, google_event_ids)
+
     def get_subscription_link(self):
         return f"https://calendar.google.com/calendar/u/0/r?cid={self.calendar_id}"
 
     # Only manual execution
     def clear_all_events(self):
         """Deletes all events from the calendar."""
-        events_result = self.service.events().list(calendarId=self.calendar_id).execute()
-        events = events_result.get('items', [])
-        for event in events:
-            self.service.events().delete(calendarId=self.calendar_id, eventId=event['id']).execute()
-            print(f"Deleted event: {event.get('summary', event['id'])}")
+        # List every page first so deleting doesn't shift the pages still to be read
+        events = []
+        page_token = None
+        while True:
+            events_result = self.service.events().list(calendarId=self.calendar_id, pageToken=page_token).execute()
+            events.extend(events_result.get('items', []))
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                break
+
+        results = self.delete_events([event['id'] for event in events])
+        for event, result in zip(events, results):
+            if result.ok:
+                print(f"Deleted event: {event.get('summary', event['id'])}")
+            else:
+                print(f"Failed to delete event {event.get('summary', event['id'])}: {result.error}")
@@ -0,0 +1,61 @@
+from typing import Dict, List, Set, Tuple
+
+from telethon.tl.types import Message
+
+from model.dialog import Dialog
+
+
+class CheckpointTracker:
+    """
+    Works out how far each dialog's checkpoint may move while the analyzer
+    chunks of a run are handled one by one, in any order. A dialog advances to
+    its newest message older than the oldest message of its first chunk still
+    outstanding, so a crash never skips a message whose chunk was not
+    committed. Failed chunks are simply never completed.
+    """
+
+    def __init__(self, dialog_messages: List[Tuple[Dialog, List[Message]]], chunks: List[List[dict]]):
+        # Every fetched message of each dialog, newest first, including the ones
+        # the pre-filter kept out of the chunks
+        self.messages: Dict[str, List[Message]] = {
+            str(dialog_object.id): messages for dialog_object, messages in dialog_messages
+        }
+        # dialog id -> {chunk index: oldest message id of the dialog in that chunk}
+        self.outstanding: Dict[str, Dict[int, int]] = {dialog_id: {} for dialog_id in self.messages}
+        self.chunk_dialogs: List[Set[str]] = []
+        for index, chunk in enumerate(chunks):
+            dialog_ids = set()
+            for message_object in chunk:
+                dialog_id = str(message_object['chat_id'])
+                oldest = self.outstanding.setdefault(dialog_id, {})
+                oldest[index] = min(oldest.get(index, message_object['message_id']), message_object['message_id'])
+                dialog_ids.add(dialog_id)
+            self.chunk_dialogs.append(dialog_ids)
+        self.committed: Dict[str, int] = {}
+
+    def complete(self, chunk_index: int) -> List[Tuple[str, int, object]]:
+        """
+        Marks a chunk as handled and returns the checkpoints it allows.
+        """
+        for dialog_id in self.chunk_dialogs[chunk_index]:
+            self.outstanding[dialog_id].pop(chunk_index, None)
+        return self.checkpoints(self.chunk_dialogs[chunk_index])
+
+    def checkpoints(self, dialog_ids=None) -> List[Tuple[str, int, object]]:
+        """
+        Returns (dialog_id, message_id, message_time) for every dialog in
+        dialog_ids (all by default) whose checkpoint can move forward.
+        """
+        checkpoints = []
+        for dialog_id in (self.messages if dialog_ids is None else dialog_ids):
+            pending = self.outstanding.get(dialog_id)
+            boundary = min(pending.values()) if pending else None
+            checkpoint = next(
+                (message for message in self.messages.get(dialog_id, ()) if boundary is None or message.id < boundary),
+                None
+            )
+            if checkpoint is None or self.committed.get(dialog_id, 0) >= checkpoint.id:
+                continue
+            self.committed[dialog_id] = checkpoint.id
+            checkpoints.append((dialog_id, checkpoint.id, checkpoint.date))
+        return checkpoints
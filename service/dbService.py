@@ -1,14 +1,47 @@
+import os
+import socket
 import sqlite3
-from typing import List, Tuple, Optional
+import time
+from typing import Callable, List, Tuple, Optional, Dict, Iterable, Set
 from datetime import datetime, timedelta
 
+# SQLite's default limit on host parameters in one statement is 999
+MAX_QUERY_PARAMETERS = 900
+
+# A claim left behind by a crashed process stops blocking others after this long
+CLAIM_SECONDS = 3600
+
+# PRAGMA user_version once the one-time migrations below have run
+SCHEMA_VERSION = 1
+
+
 class DBService:
     def __init__(self, db_path: str = "messages.db"):
         self.db_path = db_path
+        # Owner of the sent-message and event claims this process takes
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.conn = DBService.connect(db_path)
         self._create_tables()
 
+    @staticmethod
+    def connect(db_path: str) -> sqlite3.Connection:
+        """
+        Opens a long-lived connection in WAL mode. With WAL, commits only append
+        to the log, so synchronous=NORMAL is safe and avoids an fsync per commit.
+        """
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def close(self) -> None:
+        self.conn.close()
+
     def _create_tables(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with self.conn as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS dialogs (
@@ -27,8 +60,8 @@ class DBService:
                     event_id TEXT NOT NULL,
                     google_event_id TEXT,
                     title TEXT NOT NULL,
-                    start_time DATETIME NOT NULL,
-                    end_time DATETIME NOT NULL,
+                    start_time INTEGER NOT NULL,
+                    end_time INTEGER NOT NULL,
                     description TEXT,
                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                     UNIQUE(dialog_id, event_id)
@@ -39,28 +72,162 @@ class DBService:
                 cursor.execute("ALTER TABLE calendar_events ADD COLUMN google_event_id TEXT")
             except sqlite3.OperationalError:
                 pass # Column already exists
-            conn.commit()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sent_messages (
+                    fingerprint TEXT PRIMARY KEY,
+                    sent_at INTEGER NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_sent_messages_sent_at ON sent_messages(sent_at)")
+            # Idempotency keys of forwarded messages, so a resumed run never forwards twice
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS forwarded_messages (
+                    chat_id TEXT NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    forwarded_at INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, message_id)
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_forwarded_messages_forwarded_at ON forwarded_messages(forwarded_at)")
+            # Chat metadata for links and prompts, see EntityCache
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_entities (
+                    chat_id TEXT PRIMARY KEY,
+                    title TEXT,
+                    username TEXT,
+                    has_link INTEGER NOT NULL DEFAULT 0,
+                    type TEXT,
+                    updated_at INTEGER NOT NULL
+                )
+            """)
+            # Which worker is processing a dialog, until expires_at unless renewed
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS dialog_leases (
+                    dialog_id TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at INTEGER NOT NULL
+                )
+            """)
+            # Texts and events being forwarded or created by a process, so
+            # processes running at once don't both send them (see claim_sent_fingerprint)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS sent_message_claims (
+                    fingerprint TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at INTEGER NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS event_claims (
+                    dialog_id TEXT NOT NULL,
+                    event_id TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    start_time INTEGER NOT NULL,
+                    end_time INTEGER NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    PRIMARY KEY (dialog_id, event_id)
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_event_claims_start_time ON event_claims(start_time)")
+            # Resolved peers of the target dialog filter, see DialogFilterCache
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS dialog_filters (
+                    title TEXT PRIMARY KEY,
+                    version TEXT NOT NULL,
+                    peers TEXT NOT NULL,
+                    updated_at INTEGER NOT NULL
+                )
+            """)
+            # Scanning calendar_events on every start would cost more as it grows
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] < SCHEMA_VERSION:
+                self._migrate_event_times(cursor)
+                cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_calendar_events_start_time ON calendar_events(start_time)")
+
+    def _migrate_event_times(self, cursor):
+        """
+        Databases created before times were stored as epochs hold the ISO text
+        sqlite3 produced from datetime objects; convert those rows in place.
+        """
+        cursor.execute("""
+            SELECT id, start_time, end_time FROM calendar_events
+            WHERE typeof(start_time) = 'text' OR typeof(end_time) = 'text'
+        """)
+        migrated = []
+        for row_id, start_time, end_time in cursor.fetchall():
+            try:
+                migrated.append((DBService.to_epoch(start_time), DBService.to_epoch(end_time), row_id))
+            except ValueError:
+                continue # Leave rows we cannot parse untouched
+        cursor.executemany("UPDATE calendar_events SET start_time = ?, end_time = ? WHERE id = ?", migrated)
+
+    @staticmethod
+    def to_epoch(value) -> int:
+        """
+        Converts a datetime (or ISO string) to integer UTC epoch seconds. Naive
+        values are taken as local time, as datetime.timestamp() does.
+        """
+        if isinstance(value, (int, float)):
+            return int(value)
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return int(value.timestamp())
 
     def store_dialog_name(self, dialog_id: str, name: str) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
+        self.store_dialog_names([(dialog_id, name)])
+
+    def store_dialog_names(self, dialog_names: Iterable[Tuple[str, str]]) -> None:
+        """
+        Stores (dialog_id, name) pairs in a single transaction.
+        """
+        with self.conn as conn:
+            conn.executemany("""
                 INSERT OR IGNORE INTO dialogs (dialog_id, name) VALUES (?, ?)
-            """, (dialog_id, name))
-            conn.commit()
+            """, [(str(dialog_id), name) for dialog_id, name in dialog_names])
 
     def get_last_processed_message(self, dialog_id: str) -> Optional[int]:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT processed_message_id FROM dialogs WHERE dialog_id = ?", (dialog_id,))
-            result = cursor.fetchone()
-            return result[0] if result else None
-    
+        return self.get_last_processed_messages([dialog_id]).get(str(dialog_id))
+
+    def get_last_processed_messages(self, dialog_ids: List[str]) -> Dict[str, Optional[int]]:
+        """
+        Returns the processed_message_id of every known dialog in dialog_ids,
+        keyed by the dialog id as a string.
+        """
+        dialog_ids = [str(dialog_id) for dialog_id in dialog_ids]
+        last_processed = {}
+        cursor = self.conn.cursor()
+        for start in range(0, len(dialog_ids), MAX_QUERY_PARAMETERS):
+            batch = dialog_ids[start:start + MAX_QUERY_PARAMETERS]
+            placeholders = ", ".join("?" * len(batch))
+            cursor.execute(
+                f"SELECT dialog_id, processed_message_id FROM dialogs WHERE dialog_id IN ({placeholders})",
+                batch
+            )
+            last_processed.update(cursor.fetchall())
+        return last_processed
+
     def update_last_processed_message(self, dialog_id: str, message_id: int, message_time: datetime) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE dialogs SET processed_message_id = ?, processed_message_timestamp = ? WHERE dialog_id = ?", (message_id, message_time, dialog_id))
-            conn.commit()
+        self.update_last_processed_messages([(dialog_id, message_id, message_time)])
+
+    def update_last_processed_messages(self, checkpoints: Iterable[Tuple[str, int, datetime]]) -> None:
+        """
+        Stores (dialog_id, message_id, message_time) checkpoints in a single transaction.
+        A checkpoint never moves back, so overlapping batches can finish in any order.
+        """
+        with self.conn as conn:
+            self._update_checkpoints(conn, checkpoints)
+
+    @staticmethod
+    def _update_checkpoints(conn, checkpoints: Iterable[Tuple[str, int, datetime]]) -> None:
+        conn.executemany("""
+            UPDATE dialogs SET processed_message_id = ?, processed_message_timestamp = ?
+            WHERE dialog_id = ? AND (processed_message_id IS NULL OR processed_message_id < ?)
+        """, [
+            (message_id, message_time, str(dialog_id), message_id)
+            for dialog_id, message_id, message_time in checkpoints
+        ])
 
     def store_calendar_event(
         self,
@@ -72,14 +239,37 @@ class DBService:
         description: Optional[str] = None,
         google_event_id: Optional[str] = None
     ) -> None:
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR REPLACE INTO calendar_events (
-                    dialog_id, event_id, title, start_time, end_time, description, google_event_id
-                ) VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (dialog_id, event_id, title, start_time, end_time, description, google_event_id))
-            conn.commit()
+        self.store_calendar_events([{
+            "dialog_id": dialog_id,
+            "event_id": event_id,
+            "title": title,
+            "start_time": start_time,
+            "end_time": end_time,
+            "description": description,
+            "google_event_id": google_event_id,
+        }])
+
+    def store_calendar_events(self, events: Iterable[dict]) -> None:
+        """
+        Stores a batch of events in a single transaction. Each dict takes the
+        keyword arguments of store_calendar_event.
+        """
+        with self.conn as conn:
+            self._insert_calendar_events(conn, events)
+
+    @staticmethod
+    def _insert_calendar_events(conn, events: Iterable[dict]) -> None:
+        conn.executemany("""
+            INSERT OR REPLACE INTO calendar_events (
+                dialog_id, event_id, title, start_time, end_time, description, google_event_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [
+            (
+                str(event["dialog_id"]), event["event_id"], event["title"], DBService.to_epoch(event["start_time"]),
+                DBService.to_epoch(event["end_time"]), event.get("description"), event.get("google_event_id")
+            )
+            for event in events
+        ])
 
     def get_events_starting_around(
         self,
@@ -92,14 +282,19 @@ class DBService:
         """
         start_lower = start_time - timedelta(minutes=window_minutes)
         start_upper = start_time + timedelta(minutes=window_minutes)
+        return self.get_events_starting_between(start_lower, start_upper)
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM calendar_events
-                WHERE start_time >= ? AND start_time <= ?
-            """, (start_lower, start_upper))
-            return cursor.fetchall()
+    def get_events_starting_between(self, start_lower, start_upper) -> List[Tuple]:
+        """
+        Retrieve all calendar events whose start_time lies in [start_lower, start_upper].
+        Bounds are datetimes or epoch seconds.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT * FROM calendar_events
+            WHERE start_time >= ? AND start_time <= ?
+        """, (DBService.to_epoch(start_lower), DBService.to_epoch(start_upper)))
+        return cursor.fetchall()
 
     def get_events_by_time_range(
         self,
@@ -115,10 +310,243 @@ class DBService:
         start_lower = start_time - timedelta(minutes=delta_minutes)
         end_upper = end_time + timedelta(minutes=delta_minutes)
 
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT * FROM calendar_events
-                WHERE start_time >= ? AND end_time <= ?
-            """, (start_lower, end_upper))
-            return cursor.fetchall()
\ No newline at end of file
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT * FROM calendar_events
+            WHERE start_time >= ? AND end_time <= ?
+        """, (DBService.to_epoch(start_lower), DBService.to_epoch(end_upper)))
+        return cursor.fetchall()
+
+    def get_sent_fingerprints(self) -> Set[str]:
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT fingerprint FROM sent_messages")
+        return {row[0] for row in cursor.fetchall()}
+
+    def store_sent_fingerprints(self, fingerprints: Iterable[str], sent_at: int) -> None:
+        with self.conn as conn:
+            self._insert_sent_fingerprints(conn, fingerprints, sent_at)
+
+    @staticmethod
+    def _insert_sent_fingerprints(conn, fingerprints: Iterable[str], sent_at: int) -> None:
+        conn.executemany(
+            "INSERT OR REPLACE INTO sent_messages (fingerprint, sent_at) VALUES (?, ?)",
+            [(fingerprint, sent_at) for fingerprint in fingerprints]
+        )
+
+    def delete_sent_fingerprints_before(self, sent_before: int) -> None:
+        now = int(time.time())
+        with self.conn as conn:
+            conn.execute("DELETE FROM sent_messages WHERE sent_at < ?", (sent_before,))
+            conn.execute("DELETE FROM forwarded_messages WHERE forwarded_at < ?", (sent_before,))
+            conn.execute("DELETE FROM sent_message_claims WHERE expires_at < ?", (now,))
+            conn.execute("DELETE FROM event_claims WHERE expires_at < ?", (now,))
+
+    def claim_sent_fingerprint(self, fingerprint: str) -> bool:
+        """
+        Claims the fingerprint of a text about to be forwarded, unless it was
+        sent already or another process holds an unexpired claim on it. The
+        check and the claim are one statement, so of processes forwarding the
+        same text at once only one succeeds. A claim is dropped when its
+        fingerprint is committed (see commit_progress) or released.
+        """
+        now = int(time.time())
+        with self.conn as conn:
+            cursor = conn.execute("""
+                INSERT INTO sent_message_claims (fingerprint, owner, expires_at)
+                SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM sent_messages WHERE fingerprint = ?)
+                ON CONFLICT(fingerprint) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE sent_message_claims.expires_at < ?
+            """, (fingerprint, self.owner, now + CLAIM_SECONDS, fingerprint, now))
+            return cursor.rowcount == 1
+
+    def release_sent_fingerprints(self, fingerprints: Iterable[str]) -> None:
+        with self.conn as conn:
+            self._delete_sent_fingerprint_claims(conn, fingerprints)
+
+    def _delete_sent_fingerprint_claims(self, conn, fingerprints: Iterable[str]) -> None:
+        conn.executemany(
+            "DELETE FROM sent_message_claims WHERE fingerprint = ? AND owner = ?",
+            [(fingerprint, self.owner) for fingerprint in fingerprints]
+        )
+
+    def claim_calendar_events(
+        self,
+        start_lower,
+        start_upper,
+        choose: Callable[[List[Tuple]], Iterable[dict]],
+    ) -> None:
+        """
+        Passes choose the calendar events starting in [start_lower, start_upper],
+        followed by the unexpired event claims of other processes shaped like
+        calendar_events rows, and claims the events it returns (dicts with
+        dialog_id, event_id, title, start_time and end_time). Both happen in one
+        write transaction, so processes running at once never both decide to
+        create the same event. A claim is dropped when its event is committed
+        (see commit_progress) or released.
+        """
+        now = int(time.time())
+        bounds = (DBService.to_epoch(start_lower), DBService.to_epoch(start_upper))
+        with self.conn as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            candidates = conn.execute(
+                "SELECT * FROM calendar_events WHERE start_time >= ? AND start_time <= ?", bounds
+            ).fetchall()
+            candidates += [
+                (None, dialog_id, event_id, None, title, start_time, end_time, None, None)
+                for dialog_id, event_id, title, start_time, end_time in conn.execute("""
+                    SELECT dialog_id, event_id, title, start_time, end_time FROM event_claims
+                    WHERE owner != ? AND expires_at >= ? AND start_time >= ? AND start_time <= ?
+                """, (self.owner, now) + bounds)
+            ]
+            conn.executemany("""
+                INSERT OR REPLACE INTO event_claims (dialog_id, event_id, title, start_time, end_time, owner, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (
+                    str(event["dialog_id"]), str(event["event_id"]), event["title"], DBService.to_epoch(event["start_time"]),
+                    DBService.to_epoch(event["end_time"]), self.owner, now + CLAIM_SECONDS
+                )
+                for event in choose(candidates)
+            ])
+
+    def release_calendar_events(self, keys: Iterable[Tuple[str, str]]) -> None:
+        """
+        Drops this process' claims on the (dialog_id, event_id) events.
+        """
+        with self.conn as conn:
+            self._delete_event_claims(conn, keys)
+
+    def _delete_event_claims(self, conn, keys: Iterable[Tuple[str, str]]) -> None:
+        conn.executemany(
+            "DELETE FROM event_claims WHERE dialog_id = ? AND event_id = ? AND owner = ?",
+            [(str(dialog_id), str(event_id), self.owner) for dialog_id, event_id in keys]
+        )
+
+    def get_forwarded_messages(self, keys: Iterable[Tuple[str, int]]) -> Set[Tuple[str, int]]:
+        """
+        Returns the (chat_id, message_id) pairs of keys that were already forwarded.
+        """
+        keys = [(str(chat_id), int(message_id)) for chat_id, message_id in keys]
+        forwarded = set()
+        cursor = self.conn.cursor()
+        # Two parameters per key
+        batch_size = MAX_QUERY_PARAMETERS // 2
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            conditions = " OR ".join("(chat_id = ? AND message_id = ?)" for _ in batch)
+            cursor.execute(
+                f"SELECT chat_id, message_id FROM forwarded_messages WHERE {conditions}",
+                [value for key in batch for value in key]
+            )
+            forwarded.update(cursor.fetchall())
+        return forwarded
+
+    def commit_progress(
+        self,
+        checkpoints: Iterable[Tuple[str, int, datetime]] = (),
+        forwarded_messages: Iterable[Tuple[str, int]] = (),
+        sent_fingerprints: Iterable[str] = (),
+        calendar_events: Iterable[dict] = (),
+        committed_at: Optional[int] = None,
+    ) -> None:
+        """
+        Records what one analyzed chunk produced (forwarded messages, their
+        fingerprints, calendar events) together with the checkpoints it allows,
+        in a single transaction: after a crash either all of it is stored or
+        none is, and the next run resumes from the last committed chunk.
+        """
+        committed_at = committed_at if committed_at is not None else int(time.time())
+        sent_fingerprints = list(sent_fingerprints)
+        calendar_events = list(calendar_events)
+        with self.conn as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO forwarded_messages (chat_id, message_id, forwarded_at) VALUES (?, ?, ?)",
+                [(str(chat_id), int(message_id), committed_at) for chat_id, message_id in forwarded_messages]
+            )
+            self._insert_sent_fingerprints(conn, sent_fingerprints, committed_at)
+            self._insert_calendar_events(conn, calendar_events)
+            self._update_checkpoints(conn, checkpoints)
+            # Committed texts and events are blocked by their rows from now on
+            self._delete_sent_fingerprint_claims(conn, sent_fingerprints)
+            self._delete_event_claims(conn, ((event["dialog_id"], event["event_id"]) for event in calendar_events))
+
+    def get_chat_entities(self, chat_ids: Iterable[str]) -> List[Tuple]:
+        """
+        Returns (chat_id, title, username, has_link, type, updated_at) rows of
+        the known chats among chat_ids.
+        """
+        chat_ids = [str(chat_id) for chat_id in chat_ids]
+        rows = []
+        cursor = self.conn.cursor()
+        for start in range(0, len(chat_ids), MAX_QUERY_PARAMETERS):
+            batch = chat_ids[start:start + MAX_QUERY_PARAMETERS]
+            placeholders = ", ".join("?" * len(batch))
+            cursor.execute(
+                f"SELECT chat_id, title, username, has_link, type, updated_at FROM chat_entities WHERE chat_id IN ({placeholders})",
+                batch
+            )
+            rows.extend(cursor.fetchall())
+        return rows
+
+    def store_chat_entities(self, rows: Iterable[Tuple], updated_at: int) -> None:
+        """
+        Stores (chat_id, title, username, has_link, type) rows in a single transaction.
+        """
+        with self.conn as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO chat_entities (chat_id, title, username, has_link, type, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, [
+                (str(chat_id), title, username, int(bool(has_link)), chat_type, updated_at)
+                for chat_id, title, username, has_link, chat_type in rows
+            ])
+
+    def get_dialog_filter(self, title: str) -> Optional[Tuple[str, str, int]]:
+        """
+        Returns (version, peers, updated_at) of the cached dialog filter, if any.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT version, peers, updated_at FROM dialog_filters WHERE title = ?", (title,))
+        return cursor.fetchone()
+
+    def store_dialog_filter(self, title: str, version: str, peers: str, updated_at: int) -> None:
+        with self.conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO dialog_filters (title, version, peers, updated_at) VALUES (?, ?, ?, ?)",
+                (title, version, peers, updated_at)
+            )
+
+    def expire_dialog_filters(self) -> None:
+        """
+        Marks every cached dialog filter as stale, so the next run refreshes it.
+        """
+        with self.conn as conn:
+            conn.execute("UPDATE dialog_filters SET updated_at = 0")
+
+    def acquire_dialog_leases(self, owner: str, dialog_ids: Iterable[str], lease_seconds: int) -> Set[str]:
+        """
+        Leases every dialog in dialog_ids that no other owner holds an unexpired
+        lease on, and returns the ids now leased to owner.
+        """
+        dialog_ids = [str(dialog_id) for dialog_id in dialog_ids]
+        now = int(time.time())
+        with self.conn as conn:
+            conn.executemany("""
+                INSERT INTO dialog_leases (dialog_id, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(dialog_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE dialog_leases.owner = excluded.owner OR dialog_leases.expires_at < ?
+            """, [(dialog_id, owner, now + lease_seconds, now) for dialog_id in dialog_ids])
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT dialog_id FROM dialog_leases WHERE owner = ?", (owner,))
+        return {row[0] for row in cursor.fetchall()} & set(dialog_ids)
+
+    def renew_dialog_leases(self, owner: str, lease_seconds: int) -> None:
+        with self.conn as conn:
+            conn.execute(
+                "UPDATE dialog_leases SET expires_at = ? WHERE owner = ?",
+                (int(time.time()) + lease_seconds, owner)
+            )
+
+    def release_dialog_leases(self, owner: str) -> None:
+        with self.conn as conn:
+            conn.execute("DELETE FROM dialog_leases WHERE owner = ?", (owner,))
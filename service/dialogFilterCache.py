@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import json
+import time
+from typing import List, Optional
+
+from telethon import TelegramClient, events
+from telethon.tl import functions
+from telethon.tl.types import (
+    InputPeerChannel, InputPeerChat, InputPeerUser, UpdateDialogFilter, UpdateDialogFilters
+)
+from tenacity import retry, stop_after_attempt
+
+from model.dialog import Dialog
+from model.dialogType import DialogType
+from service.dbService import DBService
+from service.runMetrics import RunMetrics
+from service.util import Util
+
+# How long a refresh may take when a cached list can be used instead
+REFRESH_TIMEOUT_SECONDS = 10
+
+
+class DialogFilterCache:
+    """
+    The target dialogs of a dialog filter, resolved once and kept in the
+    dialog_filters table of messages.db with a version hash of the peer list.
+    The list is used as is until it is older than ttl_hours or Telegram sends
+    a filter update; a stale list is refreshed with a single, time-limited
+    request and still used if that fails. Only the first run, with nothing
+    cached, waits for GetDialogFiltersRequest with retries.
+    """
+
+    def __init__(
+        self,
+        db_service: DBService,
+        client: TelegramClient,
+        title: str,
+        ttl_hours: int = 24,
+        metrics: Optional[RunMetrics] = None,
+    ):
+        self.db_service = db_service
+        self.client = client
+        self.title = title
+        self.ttl_seconds = ttl_hours * 3600
+        self.metrics = metrics or RunMetrics()
+        self.version = None
+        # Whether the last refresh found a different peer list
+        self.changed = False
+
+    @staticmethod
+    def build_dialog_object(peer) -> Optional[Dialog]:
+        if type(peer) == InputPeerChannel:
+            return Dialog(peer.channel_id, DialogType.CHANNEL, peer)
+        elif type(peer) == InputPeerChat:
+            return Dialog(peer.chat_id, DialogType.CHAT, peer)
+        elif type(peer) == InputPeerUser:
+            return Dialog(peer.user_id, DialogType.USER, peer)
+        return None
+
+    @staticmethod
+    def serialize(input_peers) -> str:
+        """
+        Canonical JSON of [type, id, access_hash] per peer; its hash is the version.
+        """
+        rows = []
+        for peer in input_peers:
+            if type(peer) == InputPeerChannel:
+                rows.append(["channel", peer.channel_id, peer.access_hash])
+            elif type(peer) == InputPeerChat:
+                rows.append(["chat", peer.chat_id, None])
+            elif type(peer) == InputPeerUser:
+                rows.append(["user", peer.user_id, peer.access_hash])
+        return json.dumps(rows, separators=(",", ":"))
+
+    @staticmethod
+    def deserialize(peers: str) -> List[Dialog]:
+        dialog_objects = []
+        for peer_type, peer_id, access_hash in json.loads(peers):
+            if peer_type == "channel":
+                input_peer = InputPeerChannel(peer_id, access_hash)
+            elif peer_type == "chat":
+                input_peer = InputPeerChat(peer_id)
+            else:
+                input_peer = InputPeerUser(peer_id, access_hash)
+            dialog_objects.append(DialogFilterCache.build_dialog_object(input_peer))
+        return dialog_objects
+
+    def target_peers(self, filters) -> list:
+        for dialog_filter in filters:
+            if hasattr(dialog_filter, 'id') and dialog_filter.title == self.title:
+                return dialog_filter.include_peers
+        return []
+
+    async def fetch_filters(self):
+        with self.metrics.time("dialog_filters_request"):
+            return await self.client(functions.messages.GetDialogFiltersRequest())
+
+    @retry(stop=stop_after_attempt(5), wait=Util.wait_flood_aware(10), before_sleep=RunMetrics.count_retries("dialog_filters"))
+    async def fetch_filters_with_retry(self):
+        return await self.fetch_filters()
+
+    async def refresh(self, with_retry: bool = True) -> List[Dialog]:
+        if with_retry:
+            filters = await self.fetch_filters_with_retry()
+        else:
+            filters = await asyncio.wait_for(self.fetch_filters(), REFRESH_TIMEOUT_SECONDS)
+        peers = self.serialize(self.target_peers(filters))
+        version = hashlib.sha1(peers.encode("utf-8")).hexdigest()
+        self.changed = version != self.version
+        self.version = version
+        self.db_service.store_dialog_filter(self.title, version, peers, int(time.time()))
+        return self.deserialize(peers)
+
+    async def target_dialogs(self) -> List[Dialog]:
+        cached = self.db_service.get_dialog_filter(self.title)
+        if cached is None:
+            self.metrics.increment("dialog_filter_cache", result="miss")
+            return await self.refresh()
+        version, peers, updated_at = cached
+        self.version = version
+        if updated_at >= int(time.time()) - self.ttl_seconds:
+            self.metrics.increment("dialog_filter_cache", result="hit")
+            return self.deserialize(peers)
+        self.metrics.increment("dialog_filter_cache", result="stale")
+        try:
+            return await self.refresh(with_retry=False)
+        except Exception as e:
+            print(f"Error refreshing dialog filter {self.title}, using the cached one: {e}")
+            return self.deserialize(peers)
+
+    def watch(self, on_change=None) -> None:
+        """
+        Expires the cached list when Telegram reports a changed dialog filter.
+        With on_change, the list is also refreshed right away and, if it
+        differs, passed to on_change.
+        """
+        async def on_filter_update(update):
+            self.db_service.expire_dialog_filters()
+            if on_change is None:
+                return
+            try:
+                dialog_objects = await self.refresh()
+            except Exception as e:
+                print(f"Error refreshing dialog filter {self.title}: {e}")
+                return
+            if self.changed:
+                await on_change(dialog_objects)
+
+        self.client.add_event_handler(on_filter_update, events.Raw(types=[UpdateDialogFilter, UpdateDialogFilters]))
@@ -0,0 +1,90 @@
+import time
+from typing import Dict, List, Optional
+
+from telethon import TelegramClient
+from telethon.tl.types import Message
+
+from model.chatEntity import ChatEntity
+from model.dialog import Dialog
+from service.dbService import DBService
+from service.util import Util
+
+# Peers per bulk resolve request
+RESOLVE_BATCH_SIZE = 100
+
+
+class EntityCache:
+    """
+    Chat metadata of the target dialogs, kept in memory and in the
+    chat_entities table of messages.db, so titles and links never wait for
+    Telethon to resolve an entity, even on a cold session. load() bulk-resolves
+    the chats that are unknown or older than refresh_hours. Chats seen on
+    messages refresh their entry as they arrive and are persisted by flush().
+    """
+
+    def __init__(self, db_service: DBService, client: TelegramClient, refresh_hours: int = 24):
+        self.db_service = db_service
+        self.client = client
+        self.refresh_seconds = refresh_hours * 3600
+        self.chats: Dict[int, ChatEntity] = {}
+        self.changed: Dict[int, ChatEntity] = {}
+
+    async def load(self, dialog_objects: List[Dialog]) -> None:
+        stale_before = int(time.time()) - self.refresh_seconds
+        fresh = set()
+        for chat_id, title, username, has_link, chat_type, updated_at in self.db_service.get_chat_entities(
+            dialog_object.id for dialog_object in dialog_objects
+        ):
+            self.chats[int(chat_id)] = ChatEntity(int(chat_id), title, username, bool(has_link), chat_type)
+            if updated_at >= stale_before:
+                fresh.add(int(chat_id))
+
+        # Input peers from the dialog filter carry their access hash, so they
+        # resolve without the session's entity cache
+        to_resolve = [
+            dialog_object.input_peer or dialog_object.peer
+            for dialog_object in dialog_objects if dialog_object.id not in fresh
+        ]
+        for start in range(0, len(to_resolve), RESOLVE_BATCH_SIZE):
+            try:
+                entities = await self.client.get_entity(to_resolve[start:start + RESOLVE_BATCH_SIZE])
+            except Exception as e:
+                # Stale entries are better than none; message.chat covers unknown chats
+                print(f"Error resolving chat entities: {e}")
+                continue
+            for entity in entities:
+                self.remember(ChatEntity.from_entity(entity))
+        self.flush()
+
+    def remember(self, chat: ChatEntity) -> ChatEntity:
+        if self.chats.get(chat.chat_id) != chat:
+            self.chats[chat.chat_id] = chat
+            self.changed[chat.chat_id] = chat
+        return chat
+
+    def observe(self, message: Message) -> None:
+        """
+        Refreshes the entry of the message's chat from the entity Telethon
+        delivered with it, if any.
+        """
+        if getattr(message, "chat", None) is not None:
+            self.remember(ChatEntity.from_entity(message.chat))
+
+    def chat_of(self, message: Message) -> ChatEntity:
+        chat = self.chats.get(Util.chat_id(message))
+        if chat is not None:
+            return chat
+        if getattr(message, "chat", None) is not None:
+            return self.remember(ChatEntity.from_entity(message.chat))
+        return ChatEntity(Util.chat_id(message))
+
+    def get(self, chat_id: int) -> Optional[ChatEntity]:
+        return self.chats.get(int(chat_id))
+
+    def flush(self) -> None:
+        if not self.changed:
+            return
+        self.db_service.store_chat_entities(
+            [chat.as_row() for chat in self.changed.values()], int(time.time())
+        )
+        self.changed = {}
@@ -0,0 +1,118 @@
+import difflib
+from collections import defaultdict
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from service.dbService import DBService
+
+
+class DuplicateMatch:
+    """
+    The existing event a new event duplicates. Either google_event_id is taken
+    from the database, or event_index points at an earlier event of the same
+    batch whose calendar entry is created in this run.
+    """
+
+    def __init__(self, title: str, score: float, contained: bool,
+                 google_event_id: Optional[str] = None, event_index: Optional[int] = None):
+        self.title = title
+        self.score = score
+        self.contained = contained
+        self.google_event_id = google_event_id
+        self.event_index = event_index
+
+    def __str__(self) -> str:
+        return f"DuplicateMatch(title={self.title!r}, score={self.score:.2f}, contained={self.contained})"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+
+class EventDeduplicator:
+    """
+    Decides which new events duplicate an already stored event (or an earlier
+    event of the same batch). An event is a duplicate of the first candidate
+    starting within window_minutes whose title has a difflib ratio above
+    similarity_threshold or, with use_containment, contains or is contained in
+    its title. An inverted index of title characters narrows the candidates
+    scored: titles without a common character can neither match nor contain
+    each other, so the decisions are the same as scoring every candidate.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.6, use_containment: bool = True,
+                 window_minutes: int = 120):
+        self.similarity_threshold = similarity_threshold
+        self.use_containment = use_containment
+        self.window_minutes = window_minutes
+
+    def _is_duplicate(self, title: str, candidate_title: str) -> Tuple[bool, float, bool]:
+        """
+        Returns (duplicate, ratio, contained). The quick ratios are upper bounds
+        of ratio(), so they only skip the full comparison when it cannot pass.
+        """
+        contained = self.use_containment and (title in candidate_title or candidate_title in title)
+        matcher = difflib.SequenceMatcher(None, title, candidate_title)
+        if not contained and (
+            matcher.real_quick_ratio() <= self.similarity_threshold
+            or matcher.quick_ratio() <= self.similarity_threshold
+        ):
+            return False, 0.0, False
+        similarity = matcher.ratio()
+        return contained or similarity > self.similarity_threshold, similarity, contained
+
+    def find_duplicates(self, events: List[Tuple[str, datetime]], candidates: List[Tuple]) -> List[Optional[DuplicateMatch]]:
+        """
+        Checks all (title, start_time) events against all candidates in one pass.
+        candidates are calendar_events rows covering every event's window. Events
+        are indexed after the candidates as they are checked, so later events of
+        the batch can match earlier ones. Returns one DuplicateMatch or None per
+        event.
+        """
+        window_seconds = self.window_minutes * 60
+        # Entry: (title, start epoch, google_event_id, event_index)
+        entries = []
+        postings = defaultdict(set)
+        # An empty title is contained in every title
+        empty_entries = set()
+
+        def add_entry(title, start_epoch, google_event_id, event_index):
+            entry_id = len(entries)
+            entries.append((title, start_epoch, google_event_id, event_index))
+            if not title:
+                empty_entries.add(entry_id)
+            for char in set(title):
+                postings[char].add(entry_id)
+
+        # Schema: id, dialog_id, event_id, google_event_id, title, start_time, end_time, description, created_at
+        for candidate in candidates:
+            add_entry(candidate[4], candidate[5], candidate[3], None)
+
+        matches = []
+        for event_index, (title, start_time) in enumerate(events):
+            start_epoch = DBService.to_epoch(start_time)
+            if not title and self.use_containment:
+                entry_ids = range(len(entries))
+            else:
+                entry_ids = set().union(*(postings.get(char, ()) for char in set(title)))
+                if self.use_containment:
+                    entry_ids |= empty_entries
+                entry_ids = sorted(entry_ids)
+
+            match = None
+            # The first candidate that passes, in the order they were indexed
+            for entry_id in entry_ids:
+                entry_title, entry_start, google_event_id, owner_index = entries[entry_id]
+                if abs(entry_start - start_epoch) > window_seconds:
+                    continue
+                duplicate, similarity, contained = self._is_duplicate(title, entry_title)
+                if duplicate:
+                    match = DuplicateMatch(entry_title, similarity, contained, google_event_id, owner_index)
+                    break
+
+            matches.append(match)
+            if match is None:
+                add_entry(title, start_epoch, None, event_index)
+            else:
+                # A duplicate points at the same calendar entry as what it matched
+                add_entry(title, start_epoch, match.google_event_id, match.event_index)
+        return matches
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import time
+from typing import Any, Optional, Tuple
+
+from service.dbService import DBService
+
+
+class LLMCache:
+    """
+    Persistent cache of parsed analyzer responses, stored in messages.db next to
+    the DBService tables. Entries expire after ttl_hours and the least recently
+    used ones are evicted once the cache holds more than max_entries.
+    """
+
+    def __init__(self, db_path: str = "messages.db", ttl_hours: int = 168, max_entries: int = 5000):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.conn = DBService.connect(db_path)
+        self._create_tables()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _create_tables(self):
+        with self.conn as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    accessed_at INTEGER NOT NULL
+                )
+            """)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed_at ON llm_cache(accessed_at)")
+
+    @staticmethod
+    def make_key(base_prompt: str, model: str, schema: dict, payload: str) -> str:
+        # Whitespace differences in the payload don't change what the model sees
+        normalized_payload = ' '.join(payload.split())
+        key_source = json.dumps([base_prompt, model, schema, normalized_payload], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    def get(self, cache_key: str) -> Tuple[bool, Any]:
+        """
+        Returns (True, response) on a hit and (False, None) on a miss. A cached
+        response may itself be None when the analyzer found nothing.
+        """
+        now = int(time.time())
+        with self.conn as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT response FROM llm_cache WHERE cache_key = ? AND created_at > ?",
+                (cache_key, now - self.ttl_seconds)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                self.misses += 1
+                return False, None
+            cursor.execute("UPDATE llm_cache SET accessed_at = ? WHERE cache_key = ?", (now, cache_key))
+        self.hits += 1
+        return True, json.loads(row[0])
+
+    def put(self, cache_key: str, response: Optional[dict]) -> None:
+        now = int(time.time())
+        with self.conn as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR REPLACE INTO llm_cache (cache_key, response, created_at, accessed_at)
+                VALUES (?, ?, ?, ?)
+            """, (cache_key, json.dumps(response, ensure_ascii=False), now, now))
+            self._evict(cursor, now)
+
+    def _evict(self, cursor, now: int) -> None:
+        cursor.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl_seconds,))
+        cursor.execute("""
+            DELETE FROM llm_cache WHERE cache_key IN (
+                SELECT cache_key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
+
+    def stats(self) -> str:
+        return f'hits: {self.hits}, misses: {self.misses}'
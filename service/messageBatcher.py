@@ -0,0 +1,51 @@
+from typing import Callable, List, Optional
+
+
+class MessageBatcher:
+    """
+    Splits message objects into analyzer chunks that fit a token budget.
+    """
+
+    # Rough average for mixed Latin/Cyrillic chat text
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, max_tokens: int, message_tokens: Optional[Callable[[dict], int]] = None):
+        self.max_tokens = max_tokens
+        # Size of one message in the serialized payload; str() of the object by default
+        self.message_tokens = message_tokens or (lambda m: MessageBatcher.estimate_tokens(str(m)))
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        return len(text) // MessageBatcher.CHARS_PER_TOKEN + 1
+
+    def chunk(self, message_objects: List[dict]) -> List[List[dict]]:
+        """
+        Packs whole chats into chunks while they fit the budget. A chat that is
+        larger than the budget on its own is split over consecutive chunks.
+        """
+        chats = {}
+        for message_object in message_objects:
+            chats.setdefault(message_object['chat_id'], []).append(message_object)
+
+        chunks = []
+        current = []
+        current_tokens = 0
+        for chat_messages in chats.values():
+            sizes = [self.message_tokens(m) for m in chat_messages]
+            chat_tokens = sum(sizes)
+            if current and current_tokens + chat_tokens > self.max_tokens:
+                chunks.append(current)
+                current, current_tokens = [], 0
+            if chat_tokens <= self.max_tokens:
+                current.extend(chat_messages)
+                current_tokens += chat_tokens
+                continue
+            for message_object, size in zip(chat_messages, sizes):
+                if current and current_tokens + size > self.max_tokens:
+                    chunks.append(current)
+                    current, current_tokens = [], 0
+                current.append(message_object)
+                current_tokens += size
+        if current:
+            chunks.append(current)
+        return chunks
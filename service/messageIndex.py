@@ -0,0 +1,109 @@
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+from telethon.tl.types import Message
+
+from model.dialog import Dialog
+from service.promptSerializer import PromptSerializer
+from service.util import Util
+
+# Letters compared by the prefix tier of text recovery, for results whose text
+# the analyzer shortened
+RECOVERY_PREFIX_LETTERS = 32
+
+
+class MessageIndex:
+    """
+    Run-scoped index of fetched messages keyed by (chat_id, message_id), so ids
+    from different chats never collide, with the messages of each dialog kept
+    together for checkpointing. Entries are dicts with dialog_object,
+    dialog_name and message.
+
+    Results whose ids match nothing can be recovered by their text through
+    fingerprint tables built once, on first use: exact stripped text, then
+    letters only (see Util.normalize_letters), then the first
+    RECOVERY_PREFIX_LETTERS letters.
+    """
+
+    def __init__(self):
+        self.entries: Dict[Tuple[str, str], dict] = {}
+        self.entries_by_message_id: Dict[str, List[dict]] = {}
+        self.dialogs: Dict[int, Tuple[Dialog, str, List[Message]]] = {}
+        self.text_tables: Optional[List[Tuple[str, Dict[str, List[dict]]]]] = None
+        self.recovery_stats = Counter()
+
+    @staticmethod
+    def key(chat_id, message_id) -> Tuple[str, str]:
+        return str(chat_id), str(message_id)
+
+    def add_dialog(self, dialog_object: Dialog, dialog_name: str, messages: List[Message]) -> None:
+        """
+        Adds a dialog's messages, newest first.
+        """
+        self.dialogs[dialog_object.id] = (dialog_object, dialog_name, messages)
+        for message in messages:
+            entry = {
+                "dialog_object": dialog_object,
+                "dialog_name": dialog_name,
+                "message": message,
+            }
+            self.entries[self.key(Util.chat_id(message), message.id)] = entry
+            self.entries_by_message_id.setdefault(str(message.id), []).append(entry)
+
+    def get(self, chat_id, message_id) -> Optional[dict]:
+        """
+        Looks a message up by the chat_id/message_id pair the analyzer returned.
+        When the pair is unknown but the message id belongs to exactly one chat,
+        that message is returned, since the analyzer sometimes garbles chat ids.
+        """
+        entry = self.entries.get(self.key(chat_id, message_id))
+        if entry is not None:
+            return entry
+        candidates = self.entries_by_message_id.get(str(message_id), [])
+        if len(candidates) == 1:
+            return candidates[0]
+        return None
+
+    @staticmethod
+    def _text_keys(text: str) -> List[str]:
+        stripped = text.strip()
+        letters = Util.normalize_letters(stripped)
+        prefix = letters[:RECOVERY_PREFIX_LETTERS] if len(letters) >= RECOVERY_PREFIX_LETTERS else ""
+        return [stripped, letters, prefix]
+
+    def _build_text_tables(self) -> None:
+        tables = [("exact", {}), ("normalized", {}), ("prefix", {})]
+        for entry in self.entries.values():
+            text_keys = self._text_keys(Util.construct_message_text(entry["message"]) or "")
+            for (_, table), text_key in zip(tables, text_keys):
+                if text_key:
+                    table.setdefault(text_key, []).append(entry)
+        self.text_tables = tables
+
+    def recover(self, text: Optional[str], taken: Set[Tuple[str, str]]) -> Optional[dict]:
+        """
+        Finds the message whose text matches a result's text, skipping keys in
+        taken, trying the exact, normalized and prefix tables in that order.
+        The text is taken as echoed from the payload, with its line breaks
+        escaped. Outcomes are counted in recovery_stats.
+        """
+        if self.text_tables is None:
+            self._build_text_tables()
+        for (tier, table), text_key in zip(self.text_tables, self._text_keys(PromptSerializer.unescape(text or ""))):
+            if not text_key:
+                continue
+            for entry in table.get(text_key, ()):
+                if self.key(Util.chat_id(entry["message"]), entry["message"].id) not in taken:
+                    self.recovery_stats[tier] += 1
+                    return entry
+        self.recovery_stats["unrecovered"] += 1
+        return None
+
+    def entry_for(self, message: Message) -> dict:
+        return self.entries[self.key(Util.chat_id(message), message.id)]
+
+    def dialog_messages(self) -> List[Tuple[Dialog, List[Message]]]:
+        return [(dialog_object, messages) for dialog_object, _, messages in self.dialogs.values()]
+
+    def __len__(self) -> int:
+        return len(self.entries)
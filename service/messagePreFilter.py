@@ -0,0 +1,98 @@
+import json
+import re
+from collections import Counter
+from typing import Callable, Optional
+
+from telethon.tl.types import Message
+
+from service.util import Util
+
+
+class MessagePreFilter:
+    """
+    Drops messages that cannot matter to the analyzer before they are sent:
+    service messages, media without text, and texts with fewer than min_letters
+    letters ("+1", emoji-only replies, stickers). deny_regex drops matching
+    texts; allow_regex keeps a text regardless of every other rule.
+
+    chat_rules maps a chat id to overrides of min_letters, deny_regex and
+    allow_regex, or to {"skip": true} to drop the whole chat.
+    """
+
+    def __init__(
+        self,
+        min_letters: int = 3,
+        drop_media_only: bool = True,
+        deny_regex: Optional[str] = None,
+        allow_regex: Optional[str] = None,
+        chat_rules: Optional[dict] = None,
+        estimate_tokens: Optional[Callable[[dict], int]] = None,
+    ):
+        self.min_letters = min_letters
+        self.drop_media_only = drop_media_only
+        self.deny = self._compile(deny_regex)
+        self.allow = self._compile(allow_regex)
+        self.chat_rules = {}
+        for chat_id, rule in (chat_rules or {}).items():
+            self.chat_rules[str(chat_id)] = {
+                "skip": rule.get("skip", False),
+                "min_letters": rule.get("min_letters", min_letters),
+                "deny": self._compile(rule["deny_regex"]) if "deny_regex" in rule else self.deny,
+                "allow": self._compile(rule["allow_regex"]) if "allow_regex" in rule else self.allow,
+            }
+        # Estimated prompt tokens of a message object, for the dropped-tokens stat
+        self.estimate_tokens = estimate_tokens or (lambda message_object: 0)
+        self.dropped = Counter()
+        self.dropped_tokens = 0
+
+    @staticmethod
+    def _compile(pattern: Optional[str]):
+        return re.compile(pattern, re.IGNORECASE) if pattern else None
+
+    @classmethod
+    def from_env(cls, env, estimate_tokens: Optional[Callable[[dict], int]] = None) -> "MessagePreFilter":
+        return cls(
+            min_letters=env.prefilter_min_letters,
+            drop_media_only=env.prefilter_drop_media_only,
+            deny_regex=env.prefilter_deny_regex,
+            allow_regex=env.prefilter_allow_regex,
+            chat_rules=json.loads(env.prefilter_chat_rules) if env.prefilter_chat_rules else None,
+            estimate_tokens=estimate_tokens,
+        )
+
+    def drop_reason(self, message: Message, text: str) -> Optional[str]:
+        """
+        Returns why the message should not be analyzed, or None to keep it.
+        """
+        rule = self.chat_rules.get(str(Util.chat_id(message)))
+        if rule is not None and rule["skip"]:
+            return "chat"
+        if getattr(message, "action", None) is not None:
+            return "service"
+        text = text or ""
+        allow = rule["allow"] if rule is not None else self.allow
+        if allow is not None and allow.search(text):
+            return None
+        if self.drop_media_only and message.media is not None and not text.strip():
+            return "media"
+        min_letters = rule["min_letters"] if rule is not None else self.min_letters
+        if len(Util.normalize_letters(text)) < min_letters:
+            return "short"
+        deny = rule["deny"] if rule is not None else self.deny
+        if deny is not None and deny.search(text):
+            return "deny"
+        return None
+
+    def keep(self, message: Message, message_object: dict) -> bool:
+        """
+        Applies drop_reason and records what was dropped in the run stats.
+        """
+        reason = self.drop_reason(message, message_object['text'])
+        if reason is None:
+            return True
+        self.dropped[reason] += 1
+        self.dropped_tokens += self.estimate_tokens(message_object)
+        return False
+
+    def stats(self) -> str:
+        return f'dropped {sum(self.dropped.values())} messages ({dict(self.dropped)}), ~{self.dropped_tokens} tokens'
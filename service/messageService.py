@@ -1,15 +1,28 @@
 from telethon import TelegramClient
 from telethon.tl.types import PeerChannel
-from datetime import datetime
-from typing import List, Tuple, Any
-import difflib
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple, Any, Optional, Set, Iterable
+import asyncio
+import time
 
 from model.dialog import Dialog
 from service.util import Util
 from service.dbService import DBService
 from service.textAnalyzer import TextAnalyzer
-from service.calendarService import CalendarService
-from tenacity import retry, stop_after_attempt, wait_fixed
+from service.calendarService import CalendarService, CalendarWriteResult
+from service.messageBatcher import MessageBatcher
+from service.promptSerializer import PromptSerializer
+from service.eventDeduplicator import EventDeduplicator
+from service.sentMessageIndex import SentMessageIndex
+from service.reportQueue import ReportQueue
+from service.messageIndex import MessageIndex
+from service.checkpointTracker import CheckpointTracker
+from service.messagePreFilter import MessagePreFilter
+from service.runMetrics import RunMetrics
+from service.entityCache import EntityCache
+from service.streamDispatcher import StreamDispatcher
+
+FETCH_ATTEMPTS = 5
 
 
 class MessageService:
@@ -20,33 +33,52 @@ class MessageService:
         text_analyzer: TextAnalyzer,
         calendar_service: CalendarService,
         env: Any,
+        metrics: Optional[RunMetrics] = None,
+        entity_cache: Optional[EntityCache] = None,
     ):
         self.client = client
         self.db_service = db_service
         self.text_analyzer = text_analyzer
         self.calendar_service = calendar_service
         self.env = env
+        self.metrics = metrics or RunMetrics()
+        self.entity_cache = entity_cache or EntityCache(db_service, client)
+        self.fetch_semaphore = asyncio.Semaphore(env.fetch_concurrency)
+        self.prompt_serializer = PromptSerializer(env.prompt_format)
+        self.message_batcher = MessageBatcher(env.llm_chunk_tokens, self.prompt_serializer.estimate_message_tokens)
+        self.tokens_per_message = 0.0
+        self.message_pre_filter = MessagePreFilter.from_env(env, self.prompt_serializer.estimate_message_tokens)
+        self.event_deduplicator = EventDeduplicator(
+            similarity_threshold=env.dedup_similarity_threshold,
+            use_containment=env.dedup_containment,
+            window_minutes=env.dedup_window_minutes,
+        )
+
+    def message_object(self, message) -> dict:
+        """
+        Util.construct_message_object with the chat metadata from the entity cache.
+        """
+        return Util.construct_message_object(message, self.entity_cache.chat_of(message))
 
     async def process_dialog(
         self,
         dialog_object: Dialog,
-        sent_messages: List[str],
+        sent_messages: SentMessageIndex,
     ) -> Tuple[int, int, int]:
-        last_processed_message = self.db_service.get_last_processed_message(dialog_object.id)
-        if last_processed_message is None:
-            last_processed_message = -1
-
-        messages = await self.get_messages_with_retry(dialog_object.peer, last_processed_message)
-        messages = self.filter_recent_messages(messages)
+        last_processed_message = self.db_service.get_last_processed_message(dialog_object.id) or 0
+        messages = [
+            m async for m in self.iter_dialog_messages(dialog_object.peer, last_processed_message, self.lookback_cutoff())
+        ]
         if not messages:
             return 0, 0, 0
 
-        dialog_name = messages[0].chat.title
+        self.entity_cache.observe(messages[0])
+        dialog_name = self.entity_cache.chat_of(messages[0]).title
         self.db_service.store_dialog_name(dialog_object.id, dialog_name)
-        message_objects = list(reversed([Util.construct_message_object(m) for m in messages]))
+        message_objects = list(reversed([self.message_object(m) for m in messages]))
 
         try:
-            response = self.text_analyzer.findMessages(str(message_objects))
+            response = await self.text_analyzer.findMessages(self.prompt_serializer.serialize(message_objects))
         except Exception as e:
             await self.client.send_message(
                 PeerChannel(self.env.error_dialog_id),
@@ -75,17 +107,47 @@ class MessageService:
         dialog_name,
     ):
         messages_found = list(reversed([m for m in messages if m.id in message_ids]))
+        report_queue = self.create_report_queue()
+        submitted = {}
         for message_found in messages_found:
-            if Util.is_message_in_list(message_found.message, sent_messages):
+            fingerprint = Util.message_fingerprint(message_found.message)
+            if not sent_messages.reserve(fingerprint):
                 continue
-            try:
-                await Util.send_message_report(self.client, message_found, self.env.output_dialog_id)
-            except Exception as e:
+            report_queue.submit(message_found)
+            submitted[message_found.id] = fingerprint
+        failed_ids = {message.id for message in await self.report_failures(report_queue, lambda message: dialog_name)}
+        for message_found in messages_found:
+            if message_found.id in submitted and message_found.id not in failed_ids:
+                sent_messages.add(message_found.message)
+        # Claims are dropped once what was sent is stored
+        sent_messages.release(submitted.values())
+
+    def create_report_queue(self) -> ReportQueue:
+        return ReportQueue(
+            self.client,
+            self.env.output_dialog_id,
+            max_concurrency=self.env.report_concurrency,
+            requests_per_second=self.env.report_requests_per_second,
+            metrics=self.metrics,
+            entity_cache=self.entity_cache,
+            slot_phase=self.env.shard_index,
+            slot_stride=self.env.shard_count,
+        )
+
+    async def report_failures(self, report_queue: ReportQueue, dialog_name_of) -> List:
+        """
+        Waits for the queue to drain, reports every message that failed to send
+        and returns them.
+        """
+        failed_messages = []
+        for messages, error in await report_queue.join():
+            for message in messages:
+                failed_messages.append(message)
                 await self.client.send_message(
                     PeerChannel(self.env.error_dialog_id),
-                    f'Error processing message {message_found.id},\nFrom char: {dialog_name},\nError: {e}'
+                    f'Error processing message {message.id},\nFrom chat: {dialog_name_of(message)},\nError: {error}'
                 )
-            sent_messages.append(message_found.message)
+        return failed_messages
 
     async def handle_events(
         self,
@@ -94,286 +156,526 @@ class MessageService:
         dialog_name,
         dialog_id,
     ):
+        linked_events = []
         for event in events:
+            # Find message by both chat_id and message_id
+            message = next(
+                (
+                    m for m in messages
+                    if str(m.id) == str(event['message_id'])
+                    and str(Util.chat_id(m)) == str(event['chat_id'])
+                ),
+                None
+            )
+            linked_events.append({
+                "event": event,
+                "dialog_id": dialog_id,
+                "dialog_name": dialog_name,
+                "message": message,
+            })
+        await self.store_events(linked_events)
+
+    async def store_events(self, linked_events: List[dict]) -> None:
+        self.db_service.store_calendar_events(await self.create_events(linked_events))
+
+    async def create_events(self, linked_events: List[dict], pending_events: Iterable[dict] = ()) -> List[dict]:
+        """
+        Creates calendar entries for LLM events, each given with its dialog_id,
+        dialog_name and source message, and returns the rows to store (see
+        DBService.store_calendar_events). Duplicates of stored events, of
+        pending_events (rows created but not committed yet), or of earlier
+        events of the same batch, are recorded against the existing entry
+        instead.
+        """
+        parsed = []
+        for linked in linked_events:
+            event = linked["event"]
             try:
-                # Find message by both chat_id and message_id
-                message = next(
-                    (
-                        m for m in messages
-                        if str(m.id) == str(event['message_id'])
-                        and str(getattr(m.chat, "id", None) or getattr(m.to_id, "channel_id", None)) == str(event['chat_id'])
-                    ),
-                    None
-                )
                 start_datetime = datetime.fromisoformat(event['start_datetime'])
                 end_datetime = datetime.fromisoformat(event['end_datetime'])
+            except (KeyError, ValueError) as e:
+                await self.report_event_error(linked, e)
+                continue
+            parsed.append((linked, start_datetime, end_datetime))
+        if not parsed:
+            return []
 
-                # Check for duplicates using local fuzzy matching
-                candidates = self.db_service.get_events_starting_around(start_datetime, window_minutes=120)
-                is_duplicate = False
-                existing_google_event_id = None
-
-                for candidate in candidates:
-                    # candidate structure: (id, dialog_id, event_id, google_event_id, title, start_time, end_time, description, created_at)
-                    # Note: index 4 is title, index 3 is google_event_id (based on new schema order)
-                    # Let's verify index by name if possible, but tuple is returned.
-                    # Schema: id, dialog_id, event_id, google_event_id, title, start_time, end_time, description, created_at
-                    candidate_title = candidate[4]
-                    candidate_google_id = candidate[3]
-                    
-                    similarity = difflib.SequenceMatcher(None, event['title'], candidate_title).ratio()
-                    if similarity > 0.6 or event['title'] in candidate_title or candidate_title in event['title']:
-                        is_duplicate = True
-                        existing_google_event_id = candidate_google_id
-                        print(f"Duplicate event detected: '{event['title']}' is similar to '{candidate_title}' (score: {similarity:.2f})")
-                        break
-                
-                if is_duplicate:
-                    # Store association but skip creation
-                    self.db_service.store_calendar_event(
-                        dialog_id=dialog_id,
-                        event_id=event['message_id'],
-                        title=event['title'],
-                        start_time=start_datetime,
-                        end_time=end_datetime,
-                        description=event['description'],
-                        google_event_id=existing_google_event_id
-                    )
-                    continue
+        # One candidate query covering every event's window, scored in one pass.
+        # The new events are claimed in the same transaction, so other processes
+        # see them as candidates while they are created; a duplicate of another
+        # process' claim is stored without its calendar entry id
+        window_seconds = self.event_deduplicator.window_minutes * 60
+        start_epochs = [DBService.to_epoch(start_datetime) for _, start_datetime, _ in parsed]
+        matches = []
 
-                created_event = self.calendar_service.create_event(
-                    name=event['title'],
-                    description=event['description'] + '\n\n{}'.format(Util.get_message_link(message)),
-                    start_datetime=start_datetime,
-                    end_datetime=end_datetime
-                )
-                
-                google_event_id = created_event.get('id')
-
-                self.db_service.store_calendar_event(
-                    dialog_id=dialog_id,
-                    event_id=event['message_id'],
-                    title=event['title'],
-                    start_time=start_datetime,
-                    end_time=end_datetime,
-                    description=event['description'],
-                    google_event_id=google_event_id
+        def choose(candidates):
+            # Shaped like calendar_events rows
+            candidates += [
+                (None, row["dialog_id"], row["event_id"], row["google_event_id"], row["title"],
+                 DBService.to_epoch(row["start_time"]), DBService.to_epoch(row["end_time"]), row["description"], None)
+                for row in pending_events
+            ]
+            matches.extend(self.event_deduplicator.find_duplicates(
+                [(linked["event"]['title'], start_datetime) for linked, start_datetime, _ in parsed],
+                candidates
+            ))
+            return [
+                {
+                    "dialog_id": linked["dialog_id"],
+                    "event_id": linked["event"]['message_id'],
+                    "title": linked["event"]['title'],
+                    "start_time": start_datetime,
+                    "end_time": end_datetime,
+                }
+                for (linked, start_datetime, end_datetime), match in zip(parsed, matches) if match is None
+            ]
+
+        self.db_service.claim_calendar_events(
+            min(start_epochs) - window_seconds, max(start_epochs) + window_seconds, choose
+        )
+
+        # New events go to the calendar in one batched write, off the event loop
+        to_create = []
+        for index, ((linked, start_datetime, end_datetime), match) in enumerate(zip(parsed, matches)):
+            if match is not None:
+                continue
+            event = linked["event"]
+            try:
+                description = event['description'] + '\n\n{}'.format(
+                    Util.get_message_link(linked["message"], self.entity_cache.chat_of(linked["message"]))
                 )
             except Exception as e:
+                await self.report_event_error(linked, e)
+                continue
+            to_create.append((index, {
+                "name": event['title'],
+                "description": description,
+                "start_datetime": start_datetime,
+                "end_datetime": end_datetime,
+                "event_id": self.calendar_service.event_id_for(linked["dialog_id"], event['message_id']),
+            }))
+        try:
+            write_results = await self.calendar_service.create_events_async([spec for _, spec in to_create])
+        except Exception as e:
+            write_results = [CalendarWriteResult(error=e)] * len(to_create)
+
+        created_google_event_ids = {}
+        for (index, _), write_result in zip(to_create, write_results):
+            if not write_result.ok:
+                await self.report_event_error(parsed[index][0], write_result.error)
+                continue
+            created_google_event_ids[index] = write_result.google_event_id
+        self.db_service.release_calendar_events(
+            (linked["dialog_id"], linked["event"]['message_id'])
+            for index, ((linked, _, _), match) in enumerate(zip(parsed, matches))
+            if match is None and index not in created_google_event_ids
+        )
+
+        stored_events = []
+        for index, ((linked, start_datetime, end_datetime), match) in enumerate(zip(parsed, matches)):
+            event = linked["event"]
+            if match is None:
+                if index not in created_google_event_ids:
+                    continue
+                google_event_id = created_google_event_ids[index]
+            else:
+                # Store association but skip creation
+                if match.event_index is None:
+                    google_event_id = match.google_event_id
+                elif match.event_index in created_google_event_ids:
+                    google_event_id = created_google_event_ids[match.event_index]
+                else:
+                    # The event it duplicates was not created; a row would block it for good
+                    print(f"Skipping duplicate event '{event['title']}': '{match.title}' was not created")
+                    continue
+                print(f"Duplicate event detected: '{event['title']}' is similar to '{match.title}' (score: {match.score:.2f})")
+            stored_events.append({
+                "dialog_id": linked["dialog_id"],
+                "event_id": event['message_id'],
+                "title": event['title'],
+                "start_time": start_datetime,
+                "end_time": end_datetime,
+                "description": event['description'],
+                "google_event_id": google_event_id,
+            })
+        return stored_events
+
+    async def report_event_error(self, linked_event: dict, error: Exception) -> None:
+        await self.client.send_message(
+            PeerChannel(self.env.error_dialog_id),
+            f'Error creating event from message {linked_event["event"]["message_id"]},\nFrom chat: {linked_event["dialog_name"]},\nError: {error}'
+        )
+
+    def lookback_cutoff(self) -> datetime:
+        return datetime.now(timezone.utc) - timedelta(hours=self.env.lookback_hours)
+
+    async def iter_dialog_messages(self, dialog_peer, min_id: int, cutoff: datetime):
+        """
+        Yields the dialog's messages newest first, stopping at the first one older
+        than cutoff or at min_id, so nothing older is downloaded. Failed requests
+        are retried (FloodWait-aware) and resume after the last yielded message.
+        """
+        offset_id = 0
+        for attempt in range(1, FETCH_ATTEMPTS + 1):
+            try:
+                async with self.fetch_semaphore:
+                    async for message in self.client.iter_messages(dialog_peer, min_id=min_id, offset_id=offset_id):
+                        if message.date <= cutoff:
+                            return
+                        offset_id = message.id
+                        yield message
+                return
+            except Exception as e:
+                if attempt == FETCH_ATTEMPTS:
+                    raise
+                self.metrics.increment("retries", kind="fetch")
+                await asyncio.sleep(Util.flood_wait_seconds(e, 10))
+
+    async def stream_all_dialogs(self, dialog_objects: List[Dialog], failed_dialog_ids: Set[int]):
+        """
+        Streams (dialog_object, message) pairs of all dialogs as they arrive, at
+        most env.fetch_concurrency dialogs fetching at once. A dialog that fails is
+        reported and its id added to failed_dialog_ids; messages it yielded before
+        failing should be discarded by the caller.
+        """
+        last_processed = self.db_service.get_last_processed_messages([d.id for d in dialog_objects])
+        cutoff = self.lookback_cutoff()
+        queue = asyncio.Queue()
+
+        async def produce(dialog_object):
+            started = time.monotonic()
+            fetched_count = 0
+            try:
+                min_id = last_processed.get(str(dialog_object.id)) or 0
+                async for message in self.iter_dialog_messages(dialog_object.peer, min_id, cutoff):
+                    fetched_count += 1
+                    await queue.put((dialog_object, message))
+                # Time from the first request to the last message, including semaphore waits
+                self.metrics.observe("fetch_dialog", time.monotonic() - started, dialog=dialog_object.id)
+                self.metrics.increment("messages_fetched", fetched_count, dialog=dialog_object.id)
+            except Exception as e:
+                self.metrics.increment("fetch_failures")
+                failed_dialog_ids.add(dialog_object.id)
                 await self.client.send_message(
                     PeerChannel(self.env.error_dialog_id),
-                    f'Error creating event from message {event["message_id"]},\nFrom chat: {dialog_name},\nError: {e}'
+                    f'Error fetching messages for dialog {dialog_object.id}.\nError: {e}'
                 )
-    @retry(stop=stop_after_attempt(5), wait=wait_fixed(10))
-    async def get_messages_with_retry(self, dialog_peer, last_processed_message):
-        return await self.client.get_messages(dialog_peer, min_id=last_processed_message, limit=10000)
-    
-    def filter_recent_messages(self, messages):
-        from datetime import timedelta
-        one_day_ago = (datetime.now() - timedelta(days=1)).timestamp()
-        return [m for m in messages if m.date.timestamp() > one_day_ago]
+            finally:
+                await queue.put(None)
+
+        producers = [asyncio.create_task(produce(dialog_object)) for dialog_object in dialog_objects]
+        try:
+            remaining = len(producers)
+            while remaining:
+                item = await queue.get()
+                if item is None:
+                    remaining -= 1
+                    continue
+                yield item
+        finally:
+            for producer in producers:
+                producer.cancel()
+
+    def prepare_chunks(self, message_objects: List[dict]) -> Tuple[List[List[dict]], List[str]]:
+        """
+        Splits message objects into token-budgeted chunks and serializes each one.
+        """
+        with self.metrics.time("serialize"):
+            chunks = self.message_batcher.chunk(message_objects)
+            payloads = [self.prompt_serializer.serialize(chunk) for chunk in chunks]
+        self.metrics.increment("llm_chunks", len(chunks))
+        self.metrics.increment("serialized_bytes", sum(len(payload.encode("utf-8")) for payload in payloads))
+        self.tokens_per_message = PromptSerializer.tokens_per_message("".join(payloads), len(message_objects))
+        return chunks, payloads
+
+    async def analyze_chunk(self, index: int, chunk_count: int, chunk: List[dict], payload: str, on_item=None):
+        """
+        Returns (index, response, error); failures are reported here.
+        """
+        try:
+            return index, await self.text_analyzer.findMessages(payload, on_item), None
+        except Exception as e:
+            self.metrics.increment("llm_chunk_failures")
+            await self.client.send_message(
+                PeerChannel(self.env.error_dialog_id),
+                f'Error processing messages chunk {index + 1}/{chunk_count} ({len(chunk)} messages).\nError: {e}'
+            )
+            return index, None, e
 
     async def process_dialogs(
         self,
         dialog_objects: List[Dialog],
-        sent_messages: List[str],
+        sent_messages: SentMessageIndex,
+        report_queue: Optional[ReportQueue] = None,
     ) -> Tuple[int, int, int]:
         """
         Process all messages from all dialogs at once.
         """
-        all_messages = []
-        dialog_map = {}
+        # Gather all messages from all dialogs, preparing analyzer objects as they arrive
+        fetched = {}
+        failed_dialog_ids = set()
+        with self.metrics.time("fetch"):
+            async for dialog_object, message in self.stream_all_dialogs(dialog_objects, failed_dialog_ids):
+                dialog_messages = fetched.setdefault(dialog_object.id, (dialog_object, [], []))
+                dialog_messages[1].append(message)
+                dialog_messages[2].append(self.message_object(message))
 
-        # Gather all messages from all dialogs
-        for dialog_object in dialog_objects:
-            last_processed_message = self.db_service.get_last_processed_message(dialog_object.id)
-            if last_processed_message is None:
-                last_processed_message = -1
+        dialog_batches = [batch for batch in fetched.values() if batch[0].id not in failed_dialog_ids]
+        return await self.process_messages(dialog_batches, sent_messages, report_queue)
 
-            try:
-                messages = await self.get_messages_with_retry(dialog_object.peer, last_processed_message)
-            except Exception as e:
-                await self.client.send_message(
-                    PeerChannel(self.env.error_dialog_id),
-                    f'Error fetching messages for dialog {dialog_object.id}.\nError: {e}'
-                )
-                continue
-            messages = self.filter_recent_messages(messages)
+    async def process_messages(
+        self,
+        dialog_batches: List[Tuple[Dialog, list, List[dict]]],
+        sent_messages: SentMessageIndex,
+        report_queue: Optional[ReportQueue] = None,
+        failed_batches: Optional[List[Tuple[Dialog, list, List[dict]]]] = None,
+    ) -> Tuple[int, int, int]:
+        """
+        Analyze, report and checkpoint already fetched messages. Each batch is
+        (dialog_object, messages newest first, their message objects). Chunks are
+        handled as soon as their analysis finishes, and each one is committed
+        with the checkpoints it allows, so an interrupted run loses at most the
+        chunks in flight. Reports go through report_queue if given, so calls in
+        a row keep taking consecutive slots, or through a queue of their own.
+        The messages of chunks whose analysis failed are added to
+        failed_batches, if given, as batches of their own.
+        """
+        message_index = MessageIndex()
+        all_message_objects = []
+        dialog_names = []
+
+        for dialog_object, messages, message_objects in dialog_batches:
             if not messages:
                 continue
 
-            dialog_name = messages[0].chat.title
-            self.db_service.store_dialog_name(dialog_object.id, dialog_name)
-            for m in messages:
-                dialog_map[m.id] = {
-                    "dialog_object": dialog_object,
-                    "dialog_name": dialog_name,
-                    "message": m
-                }
-            all_messages.extend(messages)
+            # Telethon delivers each dialog's chat with its messages; keep the cache current
+            self.entity_cache.observe(messages[0])
+            dialog_name = self.entity_cache.chat_of(messages[0]).title
+            dialog_names.append((dialog_object.id, dialog_name))
+            message_index.add_dialog(dialog_object, dialog_name, messages)
+            # Dropped messages are still indexed, so they are checkpointed like the rest
+            all_message_objects.extend(
+                message_object for message, message_object in zip(messages, message_objects)
+                if self.message_pre_filter.keep(message, message_object)
+            )
 
-        if not all_messages:
+        if not len(message_index):
             return 0, 0, 0
-        
-        # Prepare message objects for analyzer
-        message_objects = list(reversed([Util.construct_message_object(m) for m in all_messages]))
+        self.db_service.store_dialog_names(dialog_names)
+        self.entity_cache.flush()
+
+        # Analyzer gets every chat oldest message first
+        chunks, payloads = self.prepare_chunks(list(reversed(all_message_objects)))
+        checkpoint_tracker = CheckpointTracker(message_index.dialog_messages(), chunks)
+        # Dialogs without anything to analyze are done already
+        self.db_service.commit_progress(checkpoints=checkpoint_tracker.checkpoints())
 
+        report_queue = report_queue or self.create_report_queue()
+        dispatcher = None
+        if self.text_analyzer.streaming:
+            dispatcher = StreamDispatcher(self, message_index, report_queue, sent_messages)
+        messages_found_count = 0
+        events_found_count = 0
+        analyses = [
+            asyncio.create_task(self.analyze_chunk(
+                index, len(chunks), chunk, payload, dispatcher.on_item(index) if dispatcher else None
+            ))
+            for index, (chunk, payload) in enumerate(zip(chunks, payloads))
+        ]
         try:
-            response = self.text_analyzer.findMessages(str(message_objects))
-        except Exception as e:
-            await self.client.send_message(
-                PeerChannel(self.env.error_dialog_id),
-                f'Error processing messages from all dialogs.\nError: {e}'
-            )
-            return len(all_messages), 0, 0
+            for analysis in asyncio.as_completed(analyses):
+                chunk_index, response, error = await analysis
+                if error is not None:
+                    if failed_batches is not None:
+                        failed_batches.extend(self.chunk_batches(message_index, chunks[chunk_index]))
+                    # Left outstanding, so its dialogs stay checkpointed before it;
+                    # whatever it dispatched before failing is still recorded
+                    if dispatcher is not None:
+                        await self.handle_chunk(
+                            chunk_index, None, message_index, report_queue, sent_messages, checkpoint_tracker,
+                            dispatcher, complete=False
+                        )
+                    continue
+                with self.metrics.time("handle_chunk"):
+                    found_count, events_count = await self.handle_chunk(
+                        chunk_index, response, message_index, report_queue, sent_messages, checkpoint_tracker,
+                        dispatcher
+                    )
+                messages_found_count += found_count
+                events_found_count += events_count
+        finally:
+            for analysis in analyses:
+                analysis.cancel()
+            if dispatcher is not None:
+                dispatcher.cancel()
+        return len(message_index), messages_found_count, events_found_count
 
+    @staticmethod
+    def chunk_batches(message_index: MessageIndex, chunk: List[dict]) -> List[Tuple[Dialog, list, List[dict]]]:
+        """
+        Regroups a chunk's message objects into dialog batches (see process_messages).
+        """
+        batches = {}
+        for message_object in chunk:
+            entry = message_index.get(message_object['chat_id'], message_object['message_id'])
+            batch = batches.setdefault(entry["dialog_object"].id, (entry["dialog_object"], [], []))
+            # Chunks hold every chat oldest message first
+            batch[1].insert(0, entry["message"])
+            batch[2].insert(0, message_object)
+        return list(batches.values())
+
+    async def handle_chunk(
+        self,
+        chunk_index: int,
+        response: Optional[dict],
+        message_index: MessageIndex,
+        report_queue: ReportQueue,
+        sent_messages: SentMessageIndex,
+        checkpoint_tracker: CheckpointTracker,
+        dispatcher: Optional[StreamDispatcher] = None,
+        complete: bool = True,
+    ) -> Tuple[int, int]:
+        """
+        Forwards the found messages and creates the events of one analyzed chunk,
+        then commits the forwarded messages, created events and the checkpoints
+        the chunk allows in one transaction. Forwarded (chat_id, message_id) keys
+        and deterministic calendar event ids make redoing a chunk whose commit
+        never happened harmless. With a dispatcher, the items it already handled
+        while the response streamed are only committed here. complete=False
+        commits them without moving checkpoints, for a chunk whose analysis failed.
+        """
         messages_found_count = 0
         events_found_count = 0
+        forwarded_messages = []
+        sent_fingerprints = []
+        calendar_events = []
+        submitted = {}
+        dispatched_event_keys = set()
+        if dispatcher is not None:
+            submitted, dispatched_event_keys, calendar_events = await dispatcher.take(chunk_index)
         if response is not None:
             results = response.get('results', [])
             events = response.get('Events', [])
             messages_found_count = len(results)
             events_found_count = len(events)
-            message_ids = [item['message_id'] for item in results]
+
             # Handle found messages
-            messages_found = list(reversed([m for m in all_messages if str(m.id) in message_ids]))
+            found_entries = {}
+            missing_results = []
+            for result in results:
+                entry = message_index.get(result.get('chat_id'), result.get('message_id'))
+                if entry is None:
+                    missing_results.append(result)
+                    continue
+                found_entries[MessageIndex.key(Util.chat_id(entry["message"]), entry["message"].id)] = entry
 
-            # Check for ID mismatch
             # Check for ID mismatch and attempt fallback
-            if len(messages_found) < messages_found_count:
-                missing_ids = [mid for mid in message_ids if mid not in [str(m.id) for m in messages_found]]
-                
+            if missing_results:
+                missing_ids = [result.get('message_id') for result in missing_results]
+
                 # Fallback: Try to find messages by text content
-                recovered_messages = []
-                for missing_id in missing_ids:
-                    # Find the result object for this missing ID to get the text
-                    missing_result = next((r for r in results if r['message_id'] == missing_id), None)
-                    if not missing_result:
+                recovered_entries = []
+                recovered_by_id = {}
+                for missing_result in missing_results:
+                    entry = message_index.recover(missing_result.get('text'), found_entries.keys())
+                    if entry is None:
                         continue
-                        
-                    missing_text = missing_result.get('text', '')
-                    # Search in all_messages for a match
-                    for m in all_messages:
-                        # Skip if already found
-                        if m in messages_found or m in recovered_messages:
-                            continue
-                        
-                        # Use loose matching or exact cleaning match
-                        if Util.construct_message_text(m).strip() == missing_text.strip(): # Strip to normalize
-                             recovered_messages.append(m)
-                             # Update the result's message_id to the real one so downstream logic works
-                             missing_result['message_id'] = str(m.id)
-                             # Update event message_ids as well if any events are linked to this hallucinated ID
-                             for event in events:
-                                 if event['message_id'] == missing_id:
-                                     event['message_id'] = str(m.id)
-                             break
-                
-                if recovered_messages:
-                    messages_found.extend(recovered_messages)
+                    m = entry["message"]
+                    recovered_entries.append(entry)
+                    found_entries[MessageIndex.key(Util.chat_id(m), m.id)] = entry
+                    recovered_by_id[MessageIndex.key(missing_result.get('chat_id'), missing_result.get('message_id'))] = entry
+                    # Update the result's ids to the real ones so downstream logic works
+                    missing_result['chat_id'] = str(Util.chat_id(m))
+                    missing_result['message_id'] = str(m.id)
+
+                # Update events linked to a hallucinated ID as well
+                for event in events:
+                    entry = recovered_by_id.get(MessageIndex.key(event.get('chat_id'), event.get('message_id')))
+                    if entry is not None:
+                        event['chat_id'] = str(Util.chat_id(entry["message"]))
+                        event['message_id'] = str(entry["message"].id)
+
+                if recovered_entries:
                     await self.client.send_message(
                         PeerChannel(self.env.error_dialog_id),
-                        f'Info: Recovered {len(recovered_messages)} messages via text fallback.\n'
+                        f'Info: Recovered {len(recovered_entries)} messages via text fallback.\n'
                         f'Original Missing IDs: {missing_ids}\n'
-                        f'Recovered IDs: {[m.id for m in recovered_messages]}'
+                        f'Recovered IDs: {[entry["message"].id for entry in recovered_entries]}\n'
+                        f'Recovery stats: {dict(message_index.recovery_stats)}'
                     )
 
                 # Re-check for remaining missing IDs
-                if len(messages_found) < messages_found_count:
-                    still_missing_ids = [mid for mid in message_ids if mid not in [str(m.id) for m in messages_found]]
-                     # Note: This list might be slightly misleading if we recovered messages but the IDs don't match anymore. 
-                     # But it's good enough to show what was originally asked for.
-                    
+                if len(recovered_entries) < len(missing_results):
+                    still_missing_ids = [
+                        result.get('message_id') for result in missing_results
+                        if MessageIndex.key(result.get('chat_id'), result.get('message_id')) not in found_entries
+                    ]
                     await self.client.send_message(
                         PeerChannel(self.env.error_dialog_id),
-                        f'Warning: LLM found {messages_found_count} messages, but only {len(messages_found)} were matched (including fallback).\n'
+                        f'Warning: LLM found {messages_found_count} messages, but only {len(found_entries)} were matched (including fallback).\n'
                         f'Still Missing IDs: {still_missing_ids}\n'
-                        f'Dialogs processed: {[d.id for d in dialog_objects]}'
-                    )
-            
-            for message_found in messages_found:
-                dialog_info = dialog_map.get(message_found.id)
-                if not dialog_info:
-                    continue
-                dialog_name = dialog_info["dialog_name"]
-                if Util.is_message_in_list(message_found.message, sent_messages):
-                    continue
-                try:
-                    await Util.send_message_report(self.client, message_found, self.env.output_dialog_id)
-                except Exception as e:
-                    await self.client.send_message(
-                        PeerChannel(self.env.error_dialog_id),
-                        f'Error processing message {message_found.id},\nFrom chat: {dialog_name},\nError: {e}'
+                        f'Dialogs processed: {sorted(checkpoint_tracker.chunk_dialogs[chunk_index])}'
                     )
-                sent_messages.append(message_found.message)
-            # Handle events
+
+            # Events first: their ids are deterministic, so creating them again after
+            # a crash is harmless, while forwards should be committed right after sending
+            linked_events = []
             for event in events:
-                dialog_info = dialog_map.get(int(event['message_id']))
-                if not dialog_info:
+                entry = message_index.get(event.get('chat_id'), event.get('message_id'))
+                if not entry:
                     continue
-                dialog_name = dialog_info["dialog_name"]
-                dialog_object = dialog_info["dialog_object"]
-                try:
-                    message = dialog_info["message"]
-                    start_datetime = datetime.fromisoformat(event['start_datetime'])
-                    end_datetime = datetime.fromisoformat(event['end_datetime'])
-                    
-                    # Check for duplicates using local fuzzy matching
-                    candidates = self.db_service.get_events_starting_around(start_datetime, window_minutes=120)
-                    is_duplicate = False
-                    existing_google_event_id = None
-
-                    for candidate in candidates:
-                        # Schema: id, dialog_id, event_id, google_event_id, title, start_time, end_time, description, created_at
-                        candidate_title = candidate[4]
-                        candidate_google_id = candidate[3]
-                        
-                        similarity = difflib.SequenceMatcher(None, event['title'], candidate_title).ratio()
-                        if similarity > 0.6 or event['title'] in candidate_title or candidate_title in event['title']:
-                            is_duplicate = True
-                            existing_google_event_id = candidate_google_id
-                            print(f"Duplicate event detected: '{event['title']}' is similar to '{candidate_title}' (score: {similarity:.2f})")
-                            break
-                    
-                    if is_duplicate:
-                        self.db_service.store_calendar_event(
-                            dialog_id=dialog_object.id,
-                            event_id=event['message_id'],
-                            title=event['title'],
-                            start_time=start_datetime,
-                            end_time=end_datetime,
-                            description=event['description'],
-                            google_event_id=existing_google_event_id
-                        )
-                        continue
+                if MessageIndex.key(Util.chat_id(entry["message"]), entry["message"].id) in dispatched_event_keys:
+                    continue
+                linked_events.append({
+                    "event": event,
+                    "dialog_id": entry["dialog_object"].id,
+                    "dialog_name": entry["dialog_name"],
+                    "message": entry["message"],
+                })
+            with self.metrics.time("store_events"):
+                if dispatcher is not None:
+                    calendar_events += await dispatcher.create_events(linked_events)
+                else:
+                    calendar_events += await self.create_events(linked_events)
 
-                    created_event = self.calendar_service.create_event(
-                        name=event['title'],
-                        description=event['description'] + '\n\n{}'.format(Util.get_message_link(message)),
-                        start_datetime=start_datetime,
-                        end_datetime=end_datetime
-                    )
-                    google_event_id = created_event.get('id')
-
-                    self.db_service.store_calendar_event(
-                        dialog_id=dialog_object.id,
-                        event_id=event['message_id'],
-                        title=event['title'],
-                        start_time=start_datetime,
-                        end_time=end_datetime,
-                        description=event['description'],
-                        google_event_id=google_event_id
-                    )
-                except Exception as e:
-                    await self.client.send_message(
-                        PeerChannel(self.env.error_dialog_id),
-                        f'Error creating event from message {event["message_id"]},\nFrom chat: {dialog_name},\nError: {e}'
-                    )
-        # Update last processed message for each dialog
-        for dialog_object in dialog_objects:
-            dialog_messages = [m for m in all_messages if dialog_map[m.id]["dialog_object"].id == dialog_object.id]
-            if dialog_messages:
-                self.db_service.update_last_processed_message(
-                    dialog_object.id, dialog_messages[0].id, dialog_messages[-1].date
+            # Messages an interrupted run already forwarded are skipped by key
+            already_forwarded = self.db_service.get_forwarded_messages(
+                (str(Util.chat_id(entry["message"])), entry["message"].id) for entry in found_entries.values()
+            )
+            for entry in found_entries.values():
+                message_found = entry["message"]
+                if MessageIndex.key(Util.chat_id(message_found), message_found.id) in submitted:
+                    continue
+                if (str(Util.chat_id(message_found)), message_found.id) in already_forwarded:
+                    continue
+                fingerprint = Util.message_fingerprint(message_found.message)
+                if not sent_messages.reserve(fingerprint):
+                    continue
+                report_queue.submit(message_found)
+                submitted[MessageIndex.key(Util.chat_id(message_found), message_found.id)] = fingerprint
+        if response is not None or submitted:
+            with self.metrics.time("report"):
+                failed_messages = await self.report_failures(
+                    report_queue, lambda message: message_index.entry_for(message)["dialog_name"]
                 )
-        return len(all_messages), messages_found_count, events_found_count
\ No newline at end of file
+            failed_keys = {MessageIndex.key(Util.chat_id(message), message.id) for message in failed_messages}
+            if dispatcher is not None:
+                dispatcher.failed |= failed_keys
+                failed_keys = dispatcher.failed
+            # Only forwards that went out block later copies of their text
+            sent_messages.release(submitted.pop(key, None) for key in failed_keys)
+            sent_messages.confirm(fingerprint for fingerprint in submitted.values() if fingerprint is not None)
+            for (chat_id, message_id), fingerprint in submitted.items():
+                forwarded_messages.append((chat_id, int(message_id)))
+                if fingerprint is not None:
+                    sent_fingerprints.append(fingerprint)
+
+        self.db_service.commit_progress(
+            checkpoints=checkpoint_tracker.complete(chunk_index) if complete else [],
+            forwarded_messages=forwarded_messages,
+            sent_fingerprints=sent_fingerprints,
+            calendar_events=calendar_events,
+        )
+        if dispatcher is not None:
+            dispatcher.committed(calendar_events)
+        return messages_found_count, events_found_count
@@ -0,0 +1,83 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from telethon.tl.types import Message
+
+from model.dialog import Dialog
+from service.util import Util
+
+
+class MicroBatcher:
+    """
+    Collects live messages and hands them to flush as (dialog_object, messages
+    newest first, message objects) batches, once max_messages are pending or
+    max_delay seconds after the first pending message, whichever comes first.
+    Flushes run in their own tasks, so add() never waits for an analysis, and
+    one at a time, in arrival order. to_message_object builds the message
+    objects (Util.construct_message_object by default).
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[Tuple[Dialog, list, List[dict]]]], Awaitable],
+        max_messages: int = 50,
+        max_delay: float = 10,
+        to_message_object: Callable[[Message], dict] = Util.construct_message_object,
+    ):
+        self.flush = flush
+        self.to_message_object = to_message_object
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self.pending: Dict[int, Tuple[Dialog, List[Message]]] = {}
+        self.pending_count = 0
+        self.flush_lock = asyncio.Lock()
+        self.timer: Optional[asyncio.Task] = None
+        self.flushes: Set[asyncio.Task] = set()
+
+    async def add(self, dialog_object: Dialog, message: Message) -> None:
+        self.pending.setdefault(dialog_object.id, (dialog_object, []))[1].append(message)
+        self.pending_count += 1
+        if self.pending_count >= self.max_messages:
+            flush = asyncio.create_task(self.flush_pending())
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    def retry(self, batches: List[Tuple[Dialog, list, List[dict]]]) -> None:
+        """
+        Puts the messages of batches whose analysis failed back among the
+        pending ones. They go out with the next flush, together with newer
+        messages of their dialogs, so those never move the dialog's checkpoint
+        past them; they start no timer of their own.
+        """
+        for dialog_object, messages, _ in batches:
+            self.pending.setdefault(dialog_object.id, (dialog_object, []))[1].extend(messages)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.max_delay)
+        self.timer = None
+        await self.flush_pending()
+
+    async def flush_pending(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending, self.pending_count = self.pending, {}, 0
+        if not pending:
+            return
+
+        batches = []
+        for dialog_object, messages in pending.values():
+            messages = sorted(messages, key=lambda m: m.id, reverse=True)
+            batches.append((dialog_object, messages, [self.to_message_object(m) for m in messages]))
+        async with self.flush_lock:
+            await self.flush(batches)
+
+    async def close(self) -> None:
+        """
+        Flushes what is pending and waits for every flush in flight.
+        """
+        await self.flush_pending()
+        while self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
@@ -0,0 +1,76 @@
+import re
+from datetime import datetime
+from itertools import groupby
+from typing import List
+
+from service.messageBatcher import MessageBatcher
+
+
+class PromptSerializer:
+    """
+    Turns message objects (see Util.construct_message_object) into the analyzer
+    payload. The compact format writes one header per chat and one row per
+    message, with times given in minutes before a reference time:
+
+        Messages as "message_id|minutes before ref|text"; ref: 2024-05-10T18:30:00+02:00
+        # chat 1234567|Chat title
+        101|95|first message
+        102|3|second message\\nwith an escaped line break
+
+    The reference time is the newest message's time, so the same messages always
+    serialize to the same payload and keep hitting the LLM cache. The legacy
+    format is Python str() of the object list.
+    """
+
+    COMPACT = "compact"
+    LEGACY = "legacy"
+
+    def __init__(self, prompt_format: str = COMPACT):
+        if prompt_format not in (self.COMPACT, self.LEGACY):
+            raise ValueError(f"Unknown prompt format: {prompt_format}")
+        self.format = prompt_format
+
+    @staticmethod
+    def _escape(text: str) -> str:
+        return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+    @staticmethod
+    def unescape(text: str) -> str:
+        """
+        Reverses the escaping of message texts in the compact format, for texts
+        the analyzer echoes back (see MessageIndex.recover).
+        """
+        return re.sub(r"\\([\\n])", lambda match: "\n" if match.group(1) == "n" else "\\", text)
+
+    def serialize(self, message_objects: List[dict]) -> str:
+        if self.format == self.LEGACY:
+            return str(message_objects)
+        if not message_objects:
+            return ""
+
+        times = [datetime.fromisoformat(m['datetime']) for m in message_objects]
+        reference = max(times)
+        lines = [f'Messages as "message_id|minutes before ref|text"; ref: {reference.isoformat()}']
+        rows = zip(message_objects, times)
+        for chat_id, chat_rows in groupby(rows, key=lambda row: row[0]['chat_id']):
+            chat_rows = list(chat_rows)
+            lines.append(f"# chat {chat_id}|{self._escape(chat_rows[0][0]['chat_title'] or '')}")
+            for message_object, message_time in chat_rows:
+                minutes_before = int((reference - message_time).total_seconds() // 60)
+                lines.append(f"{message_object['message_id']}|{minutes_before}|{self._escape(message_object['text'] or '')}")
+        return "\n".join(lines)
+
+    def estimate_message_tokens(self, message_object: dict) -> int:
+        """
+        Estimated tokens one message adds to the payload, chat header excluded.
+        """
+        if self.format == self.LEGACY:
+            return MessageBatcher.estimate_tokens(str(message_object))
+        row = f"{message_object['message_id']}|0000|{self._escape(message_object['text'] or '')}"
+        return MessageBatcher.estimate_tokens(row)
+
+    @staticmethod
+    def tokens_per_message(payload: str, message_count: int) -> float:
+        if not message_count:
+            return 0.0
+        return MessageBatcher.estimate_tokens(payload) / message_count
@@ -0,0 +1,180 @@
+import asyncio
+import math
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+from telethon.tl.types import Message, PeerChannel
+from tenacity import retry, retry_if_exception_type, stop_after_attempt
+
+from service.entityCache import EntityCache
+from service.runMetrics import RunMetrics
+from service.util import Util
+
+# forward_messages accepts at most 100 message ids per request
+MAX_FORWARD_IDS = 100
+# Telegram rejects longer text messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+class ReportQueue:
+    """
+    Outbound queue for found-message reports of one run, or of the whole
+    daemon. Whatever is queued when the worker wakes up is grouped by source
+    chat; each group is sent as its links, in as few messages as the length
+    limit allows, plus one multi-id forward, scheduled in its own one-minute slot so the output channel shows
+    them as unread. Slots follow on from the ones already taken, but never lie
+    in the past. They are minutes of the wall clock, and with slot_stride > 1
+    only those with minute % slot_stride == slot_phase are used, so the queues
+    of worker processes never share a slot. Groups are sent concurrently, at
+    most requests_per_second API calls overall.
+    """
+
+    def __init__(
+        self,
+        client: TelegramClient,
+        output_dialog_id: int,
+        max_concurrency: int = 4,
+        requests_per_second: float = 1.0,
+        metrics: Optional[RunMetrics] = None,
+        entity_cache: Optional[EntityCache] = None,
+        slot_phase: int = 0,
+        slot_stride: int = 1,
+    ):
+        self.client = client
+        self.metrics = metrics or RunMetrics()
+        self.entity_cache = entity_cache
+        self.output_peer = PeerChannel(output_dialog_id)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.min_interval = 1 / requests_per_second
+        self.rate_lock = asyncio.Lock()
+        self.last_request_at = 0.0
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.worker: Optional[asyncio.Task] = None
+        self.sends = set()
+        self.slot_phase = slot_phase
+        self.slot_stride = slot_stride
+        # The next free slot, in minutes since the epoch
+        self.next_slot = 0
+        self.failures: List[Tuple[List[Message], Exception]] = []
+
+    def submit(self, message: Message) -> None:
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+        self.queue.put_nowait(message)
+
+    async def join(self) -> List[Tuple[List[Message], Exception]]:
+        """
+        Waits until every submitted message is sent and returns the groups that
+        failed since the previous join. The queue can be reused afterwards.
+        """
+        # Streamed chunks may submit while this waits, so repeat until nothing is left
+        while True:
+            await self.queue.join()
+            if self.sends:
+                await asyncio.gather(*self.sends)
+            if self.queue.empty() and not self.sends:
+                break
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+        failures, self.failures = self.failures, []
+        return failures
+
+    async def _run(self) -> None:
+        while True:
+            messages = [await self.queue.get()]
+            while not self.queue.empty():
+                messages.append(self.queue.get_nowait())
+
+            by_chat: Dict[int, List[Message]] = {}
+            for message in messages:
+                by_chat.setdefault(message.chat_id, []).append(message)
+            for chat_messages in by_chat.values():
+                for start in range(0, len(chat_messages), MAX_FORWARD_IDS):
+                    group = sorted(chat_messages[start:start + MAX_FORWARD_IDS], key=lambda m: m.id)
+                    now = time.time()
+                    slot = max(self.next_slot, math.ceil(now / 60) + 1)
+                    slot += (self.slot_phase - slot) % self.slot_stride
+                    self.next_slot = slot + self.slot_stride
+                    send = asyncio.create_task(self._send_group(group, slot * 60 - now))
+                    self.sends.add(send)
+                    send.add_done_callback(self.sends.discard)
+            for _ in messages:
+                self.queue.task_done()
+
+    def _link(self, message: Message) -> str:
+        if self.entity_cache is None:
+            return Util.get_message_link(message)
+        return Util.get_message_link(message, self.entity_cache.chat_of(message))
+
+    def _link_texts(self, group: List[Message]) -> List[str]:
+        """
+        The group's links as texts within MAX_MESSAGE_LENGTH. Basic groups have
+        no message links, so their repeated 'From chat:' line is given once.
+        """
+        texts = []
+        lines = []
+        length = 0
+        for line in dict.fromkeys(self._link(message) for message in group):
+            if lines and length + 1 + len(line) > MAX_MESSAGE_LENGTH:
+                texts.append('\n'.join(lines))
+                lines, length = [], 0
+            length += len(line) + (1 if lines else 0)
+            lines.append(line)
+        if lines:
+            texts.append('\n'.join(lines))
+        return texts
+
+    async def _throttle(self) -> None:
+        async with self.rate_lock:
+            delay = self.last_request_at + self.min_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.last_request_at = time.monotonic()
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=Util.wait_flood_aware(5),
+        retry=retry_if_exception_type(FloodWaitError),
+        before_sleep=RunMetrics.count_retries("report"),
+        reraise=True,
+    )
+    async def _send_links(self, text: str, delay: float) -> None:
+        await self._throttle()
+        with self.metrics.time("report_request", request="links"):
+            await self.client.send_message(
+                self.output_peer,
+                text,
+                link_preview=False,
+                schedule=timedelta(seconds=delay)
+            )
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=Util.wait_flood_aware(5),
+        retry=retry_if_exception_type(FloodWaitError),
+        before_sleep=RunMetrics.count_retries("report"),
+        reraise=True,
+    )
+    async def _forward(self, group: List[Message], delay: float) -> None:
+        await self._throttle()
+        with self.metrics.time("report_request", request="forward"):
+            await self.client.forward_messages(
+                self.output_peer,
+                group,
+                schedule=timedelta(seconds=delay + 30)
+            )
+
+    async def _send_group(self, group: List[Message], delay: float) -> None:
+        async with self.semaphore:
+            try:
+                for text in self._link_texts(group):
+                    await self._send_links(text, delay)
+                await self._forward(group, delay)
+                self.metrics.increment("messages_forwarded", len(group))
+            except Exception as e:
+                self.metrics.increment("report_failures", len(group))
+                self.failures.append((group, e))
@@ -0,0 +1,169 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class RunMetrics:
+    """
+    Collects stage timings and counters (tokens, bytes, retries, errors) of one
+    run. Timings keep count, sum and max per stage and label set. The result is
+    written as a Prometheus textfile, for node_exporter's textfile collector,
+    and appended as one JSON line to a run record.
+    """
+
+    def __init__(self, prefix: str = "telegram_analyzer"):
+        self.prefix = prefix
+        self.started_at = time.time()
+        self.timings: Dict[MetricKey, List[float]] = {}
+        self.counters: Dict[MetricKey, float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> MetricKey:
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def observe(self, stage: str, seconds: float, **labels) -> None:
+        timing = self.timings.setdefault(self._key(stage, labels), [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def time(self, stage: str, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - started, **labels)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    @staticmethod
+    def cached_prompt_tokens(usage) -> int:
+        """
+        Prompt tokens the provider read from its prompt cache, 0 if not reported.
+        """
+        details = getattr(usage, "prompt_tokens_details", None)
+        return getattr(details, "cached_tokens", None) or 0
+
+    def record_usage(self, usage, **labels) -> None:
+        """
+        Adds the token counts (and cost, when the provider reports it) of a
+        completion's usage block.
+        """
+        if usage is None:
+            return
+        self.increment("llm_prompt_tokens", getattr(usage, "prompt_tokens", None) or 0, **labels)
+        self.increment("llm_cached_prompt_tokens", self.cached_prompt_tokens(usage), **labels)
+        self.increment("llm_completion_tokens", getattr(usage, "completion_tokens", None) or 0, **labels)
+        cost = getattr(usage, "cost", None)
+        if cost is not None:
+            self.increment("llm_cost_usd", cost, **labels)
+
+    @staticmethod
+    def count_retries(kind: str):
+        """
+        Tenacity before_sleep hook counting retries of a method whose instance
+        has a metrics attribute.
+        """
+        def before_sleep(retry_state):
+            metrics = getattr(retry_state.args[0], "metrics", None) if retry_state.args else None
+            if metrics is not None:
+                metrics.increment("retries", kind=kind)
+        return before_sleep
+
+    def merge_record(self, record: dict) -> None:
+        """
+        Adds the stages and counters of a record made by to_record, e.g. one
+        returned by a worker process.
+        """
+        for stage in record.get("stages", []):
+            timing = self.timings.setdefault(self._key(stage["stage"], stage["labels"]), [0, 0.0, 0.0])
+            timing[0] += stage["count"]
+            timing[1] += stage["sum"]
+            timing[2] = max(timing[2], stage["max"])
+        for counter in record.get("counters", []):
+            self.increment(counter["name"], counter["value"], **counter["labels"])
+
+    def stage_seconds(self, stage: str) -> float:
+        """
+        Total time of a stage over all its label sets.
+        """
+        return sum(timing[1] for (stage_name, _), timing in self.timings.items() if stage_name == stage)
+
+    def counter(self, name: str, **labels) -> float:
+        return self.counters.get(self._key(name, labels), 0)
+
+    def total(self, name: str) -> float:
+        """
+        Sum of a counter over all its label sets.
+        """
+        return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def to_record(self, **extra) -> dict:
+        record = {
+            "started_at": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            "duration_seconds": round(time.time() - self.started_at, 3),
+            "stages": [
+                {"stage": stage, "labels": dict(labels), "count": count, "sum": round(total, 6), "max": round(maximum, 6)}
+                for (stage, labels), (count, total, maximum) in sorted(self.timings.items())
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+        }
+        record.update(extra)
+        return record
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            '{}="{}"'.format(label, value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+            for label, value in labels
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def to_prometheus(self) -> str:
+        lines = []
+        stage_metric = f"{self.prefix}_stage_seconds"
+        lines.append(f"# HELP {stage_metric} Time spent per run stage.")
+        lines.append(f"# TYPE {stage_metric} summary")
+        for (stage, labels), (count, total, _) in sorted(self.timings.items()):
+            formatted = self._format_labels((("stage", stage),) + labels)
+            lines.append(f"{stage_metric}_sum{formatted} {total}")
+            lines.append(f"{stage_metric}_count{formatted} {count}")
+        lines.append(f"# TYPE {stage_metric}_max gauge")
+        for (stage, labels), (_, _, maximum) in sorted(self.timings.items()):
+            lines.append(f"{stage_metric}_max{self._format_labels((('stage', stage),) + labels)} {maximum}")
+
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            metric = f"{self.prefix}_{name}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{self._format_labels(labels)} {value}")
+
+        lines.append(f"# TYPE {self.prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{self.prefix}_last_run_timestamp_seconds {self.started_at}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str) -> None:
+        # Written aside and renamed, so the collector never reads a partial file
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+    def append_record(self, path: str, **extra) -> None:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.to_record(**extra), ensure_ascii=False) + "\n")
@@ -0,0 +1,61 @@
+import time
+from typing import Iterable, Optional
+
+from service.util import Util
+from service.dbService import DBService
+
+
+class SentMessageIndex:
+    """
+    Fingerprints of messages already forwarded to the output channel, held in a
+    set for O(1) duplicate checks and persisted in messages.db so duplicates are
+    caught across runs. Texts being forwarded are claimed in messages.db, so
+    processes running at once don't forward the same text either.
+    Fingerprints older than retention_days are dropped.
+    """
+
+    def __init__(self, db_service: DBService, retention_days: int = 7):
+        self.db_service = db_service
+        cutoff = int(time.time()) - retention_days * 86400
+        self.db_service.delete_sent_fingerprints_before(cutoff)
+        self.fingerprints = self.db_service.get_sent_fingerprints()
+        # Fingerprints of forwards not known to have succeeded yet
+        self.in_flight = set()
+
+    def add(self, text: Optional[str]) -> None:
+        fingerprint = Util.message_fingerprint(text)
+        if fingerprint is not None and fingerprint not in self.fingerprints:
+            self.fingerprints.add(fingerprint)
+            self.db_service.store_sent_fingerprints([fingerprint], int(time.time()))
+
+    def reserve(self, fingerprint: Optional[str]) -> bool:
+        """
+        Claims the fingerprint (see Util.message_fingerprint) of a text about to
+        be forwarded and returns whether it may go out: not when it was sent
+        already, or is in flight here or in another process. The caller
+        confirms it once the forward succeeded, to be stored with the rest of
+        its transaction (see DBService.commit_progress), or releases it. A text
+        without a fingerprint cannot be told apart and is always forwarded.
+        """
+        if fingerprint is None:
+            return True
+        if fingerprint in self.fingerprints or fingerprint in self.in_flight:
+            return False
+        # Texts forwarded or claimed by other processes since this index was loaded
+        if not self.db_service.claim_sent_fingerprint(fingerprint):
+            return False
+        self.in_flight.add(fingerprint)
+        return True
+
+    def confirm(self, fingerprints: Iterable[str]) -> None:
+        for fingerprint in fingerprints:
+            self.in_flight.discard(fingerprint)
+            self.fingerprints.add(fingerprint)
+
+    def release(self, fingerprints: Iterable[Optional[str]]) -> None:
+        fingerprints = [fingerprint for fingerprint in fingerprints if fingerprint is not None]
+        self.in_flight.difference_update(fingerprints)
+        self.db_service.release_sent_fingerprints(fingerprints)
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
@@ -0,0 +1,222 @@
+import asyncio
+import hashlib
+import os
+import socket
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import List, Tuple
+
+from telethon import TelegramClient
+from telethon.tl.types import PeerChannel, PeerChat
+
+from model.dialog import Dialog
+from model.dialogType import DialogType
+from model.envLoader import EnvLoader
+from service.calendarService import CalendarService
+from service.dbService import DBService
+from service.entityCache import EntityCache
+from service.llmCache import LLMCache
+from service.messageService import MessageService
+from service.runMetrics import RunMetrics
+from service.sentMessageIndex import SentMessageIndex
+from service.textAnalyzer import TextAnalyzer
+
+
+class ShardRunner:
+    """
+    Splits the target dialogs over worker processes by a stable hash of the
+    dialog id and runs process_dialogs in each. Every worker connects with its
+    own copy of the main session file, since a Telethon SQLite session cannot
+    be shared between processes. Workers only process dialogs they hold a
+    lease on in messages.db (see DBService.acquire_dialog_leases), so runs that
+    overlap never handle the same dialog at once. The workers share one
+    Telegram account and API key, so each gets its share of the budgets (see
+    ShardEnv).
+    """
+
+    def __init__(self, workers: int, session_name: str = "main"):
+        self.workers = workers
+        self.session_name = session_name
+
+    @staticmethod
+    def shard_of(dialog_id, workers: int) -> int:
+        # Python's hash() of str is salted per process, so it can't be used here
+        return int(hashlib.sha1(str(dialog_id).encode("utf-8")).hexdigest(), 16) % workers
+
+    @staticmethod
+    def dialog_spec(dialog_object: Dialog) -> Tuple[int, DialogType]:
+        if isinstance(dialog_object.peer, PeerChannel):
+            return dialog_object.id, DialogType.CHANNEL
+        if isinstance(dialog_object.peer, PeerChat):
+            return dialog_object.id, DialogType.CHAT
+        return dialog_object.id, DialogType.USER
+
+    def partition(self, dialog_objects: List[Dialog]) -> List[List[Tuple[int, DialogType]]]:
+        shards = [[] for _ in range(self.workers)]
+        for dialog_object in dialog_objects:
+            shards[self.shard_of(dialog_object.id, self.workers)].append(self.dialog_spec(dialog_object))
+        return shards
+
+    def prepare_session(self, shard_index: int) -> str:
+        """
+        Copies the authorized main session for a worker and returns its name.
+        """
+        shard_session = f"{self.session_name}-shard{shard_index}"
+        # The main client keeps its session open, so copy it through SQLite
+        # rather than the file, which may be mid-write
+        source = sqlite3.connect(f"{self.session_name}.session")
+        target = sqlite3.connect(f"{shard_session}.session")
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        return shard_session
+
+    async def run(self, dialog_objects: List[Dialog]) -> List[dict]:
+        """
+        Runs every non-empty shard in its own process and returns the worker
+        summaries (see run_shard). A shard that crashed is returned as
+        {"shard": index, "error": "..."}.
+        """
+        shards = [(index, specs) for index, specs in enumerate(self.partition(dialog_objects)) if specs]
+        if not shards:
+            return []
+        loop = asyncio.get_running_loop()
+        # spawn, so workers don't inherit the parent's connected client and event loop
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=get_context("spawn")) as executor:
+            futures = [
+                loop.run_in_executor(executor, run_shard, index, self.workers, specs, self.prepare_session(index))
+                for index, specs in shards
+            ]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        summaries = []
+        for (index, _), result in zip(shards, results):
+            if isinstance(result, BaseException):
+                summaries.append({"shard": index, "error": str(result)})
+            else:
+                summaries.append(result)
+        return summaries
+
+
+class ShardEnv(EnvLoader):
+    """
+    The settings of one of shard_count worker processes. The concurrency and
+    rate limits are split between the workers, and the report queue only
+    takes the worker's share of the output channel's schedule slots.
+    """
+
+    def __init__(self, shard_index: int, shard_count: int):
+        super().__init__()
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+
+    def _share(self, budget: int) -> int:
+        return max(1, budget // self._shard_count)
+
+    @property
+    def shard_index(self):
+        return self._shard_index
+
+    @property
+    def shard_count(self):
+        return self._shard_count
+
+    @property
+    def fetch_concurrency(self):
+        return self._share(super().fetch_concurrency)
+
+    @property
+    def llm_concurrency(self):
+        return self._share(super().llm_concurrency)
+
+    @property
+    def report_concurrency(self):
+        return self._share(super().report_concurrency)
+
+    @property
+    def report_requests_per_second(self):
+        return super().report_requests_per_second / self._shard_count
+
+
+def run_shard(shard_index: int, shard_count: int, dialog_specs: List[Tuple[int, DialogType]], session_name: str) -> dict:
+    """
+    Worker process entry point.
+    """
+    return asyncio.run(_run_shard(shard_index, shard_count, dialog_specs, session_name))
+
+
+async def keep_leases(db_service: DBService, owner: str, lease_seconds: int) -> None:
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        db_service.renew_dialog_leases(owner, lease_seconds)
+
+
+async def _run_shard(shard_index: int, shard_count: int, dialog_specs: List[Tuple[int, DialogType]], session_name: str) -> dict:
+    env = ShardEnv(shard_index, shard_count)
+    metrics = RunMetrics()
+    owner = f"{socket.gethostname()}:{os.getpid()}:shard{shard_index}"
+    summary = {
+        "shard": shard_index,
+        "dialogs": 0,
+        "skipped_dialogs": 0,
+        "processed": 0,
+        "found": 0,
+        "events": 0,
+    }
+
+    db_service = DBService()
+    leased = db_service.acquire_dialog_leases(owner, [dialog_id for dialog_id, _ in dialog_specs], env.shard_lease_seconds)
+    dialog_objects = [Dialog(dialog_id, dialog_type) for dialog_id, dialog_type in dialog_specs if str(dialog_id) in leased]
+    summary["dialogs"] = len(dialog_objects)
+    summary["skipped_dialogs"] = len(dialog_specs) - len(dialog_objects)
+    if not dialog_objects:
+        db_service.close()
+        return summary
+
+    client = TelegramClient(session_name, env.telegram_api_id, env.telegram_api_hash)
+    llm_cache = LLMCache(ttl_hours=env.llm_cache_ttl_hours, max_entries=env.llm_cache_max_entries)
+    text_analyzer = TextAnalyzer(
+        env.openrouter_api_key, env.base_prompt, env.llm_model, env.llm_concurrency, llm_cache, metrics,
+        streaming=env.llm_streaming,
+    )
+    heartbeat = asyncio.create_task(keep_leases(db_service, owner, env.shard_lease_seconds))
+    try:
+        # No interactive login in a worker; the copied session must be authorized
+        await client.connect()
+        if not await client.is_user_authorized():
+            raise RuntimeError(f"Session {session_name} is not authorized")
+        # The main process has just refreshed the cache, so this only reads messages.db
+        entity_cache = EntityCache(db_service, client, env.entity_refresh_hours)
+        await entity_cache.load(dialog_objects)
+        message_service = MessageService(
+            client=client,
+            db_service=db_service,
+            text_analyzer=text_analyzer,
+            calendar_service=CalendarService(env.calendar_id, metrics=metrics),
+            env=env,
+            metrics=metrics,
+            entity_cache=entity_cache,
+        )
+        sent_messages = SentMessageIndex(db_service, env.sent_messages_retention_days)
+        processed, found, events = await message_service.process_dialogs(dialog_objects, sent_messages)
+        summary.update({
+            "processed": processed,
+            "found": found,
+            "events": events,
+            "tokens_per_message": message_service.tokens_per_message,
+            "pre_filter_dropped": dict(message_service.message_pre_filter.dropped),
+            "pre_filter_dropped_tokens": message_service.message_pre_filter.dropped_tokens,
+            "llm_cache_hits": llm_cache.hits,
+            "llm_cache_misses": llm_cache.misses,
+            "metrics": metrics.to_record(),
+        })
+        return summary
+    finally:
+        heartbeat.cancel()
+        db_service.release_dialog_leases(owner)
+        await text_analyzer.close()
+        llm_cache.close()
+        db_service.close()
+        await client.disconnect()
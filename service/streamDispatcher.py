@@ -0,0 +1,164 @@
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+
+from service.messageIndex import MessageIndex
+from service.reportQueue import ReportQueue
+from service.sentMessageIndex import SentMessageIndex
+from service.util import Util
+
+MessageKey = Tuple[str, str]
+
+
+class StreamDispatcher:
+    """
+    Hands the results and events of streamed analyzer responses to the report
+    queue and the calendar while the completion is still arriving, instead of
+    after the whole chunk was answered. A chunk's results are submitted
+    together once their array is closed, so they are reported in the same
+    per-chat groups as without streaming, while the Events array that follows
+    is still arriving. Only items that match a message directly are
+    dispatched early; recovery of garbled ids is left to
+    handle_chunk, which skips what was dispatched here and commits it with the
+    chunk. Events are written in batches: those arriving while a calendar
+    write is in flight go out together in the next one. Event creation is
+    serialized over the run, and events created but not yet committed take
+    part in deduplication like stored ones.
+    """
+
+    def __init__(
+        self,
+        message_service,
+        message_index: MessageIndex,
+        report_queue: ReportQueue,
+        sent_messages: SentMessageIndex,
+    ):
+        self.message_service = message_service
+        self.message_index = message_index
+        self.report_queue = report_queue
+        self.sent_messages = sent_messages
+        # chunk index -> results waiting for their array to close
+        self.results: Dict[int, List[dict]] = {}
+        # chunk index -> {message key: sent fingerprint} of forwards submitted early
+        self.submitted: Dict[int, Dict[MessageKey, Optional[str]]] = {}
+        # chunk index -> keys of the messages whose events were dispatched
+        self.event_keys: Dict[int, Set[MessageKey]] = {}
+        # (chunk index, linked event) waiting for the next calendar write
+        self.event_batch: List[Tuple[int, dict]] = []
+        self.writing_chunks: Set[int] = set()
+        self.event_writer: Optional[asyncio.Task] = None
+        self.event_error: Optional[Exception] = None
+        self.events_written = asyncio.Condition()
+        # chunk index -> calendar rows created for its dispatched events
+        self.event_rows: Dict[int, List[dict]] = {}
+        # Calendar rows created but not committed yet
+        self.pending_events: List[dict] = []
+        # Forwards that failed; a failure may surface while another chunk waits on the queue
+        self.failed: Set[MessageKey] = set()
+        self.event_lock = asyncio.Lock()
+
+    def on_item(self, chunk_index: int):
+        """
+        Returns the TextAnalyzer.findMessages callback for one chunk.
+        """
+        async def dispatch(key: str, item: Optional[dict]) -> None:
+            if key == "results":
+                if item is not None:
+                    self.results.setdefault(chunk_index, []).append(item)
+                else:
+                    self.submit_results(chunk_index)
+            elif key == "Events" and item is not None:
+                self.start_event(chunk_index, item)
+        return dispatch
+
+    def submit_results(self, chunk_index: int) -> None:
+        for result in self.results.pop(chunk_index, []):
+            self.submit(chunk_index, result)
+
+    def submit(self, chunk_index: int, result: dict) -> None:
+        entry = self.message_index.get(result.get('chat_id'), result.get('message_id'))
+        if entry is None:
+            return
+        message = entry["message"]
+        key = MessageIndex.key(Util.chat_id(message), message.id)
+        submitted = self.submitted.setdefault(chunk_index, {})
+        if key in submitted:
+            return
+        if self.message_service.db_service.get_forwarded_messages([(str(Util.chat_id(message)), message.id)]):
+            return
+        fingerprint = Util.message_fingerprint(message.message)
+        if not self.sent_messages.reserve(fingerprint):
+            return
+        self.report_queue.submit(message)
+        submitted[key] = fingerprint
+        self.message_service.metrics.increment("stream_dispatched", kind="result")
+
+    def start_event(self, chunk_index: int, event: dict) -> None:
+        entry = self.message_index.get(event.get('chat_id'), event.get('message_id'))
+        if entry is None:
+            return
+        key = MessageIndex.key(Util.chat_id(entry["message"]), entry["message"].id)
+        keys = self.event_keys.setdefault(chunk_index, set())
+        if key in keys:
+            return
+        keys.add(key)
+        self.event_batch.append((chunk_index, {
+            "event": event,
+            "dialog_id": entry["dialog_object"].id,
+            "dialog_name": entry["dialog_name"],
+            "message": entry["message"],
+        }))
+        self.message_service.metrics.increment("stream_dispatched", kind="event")
+        if self.event_writer is None or self.event_writer.done():
+            self.event_writer = asyncio.create_task(self._write_events())
+
+    async def _write_events(self) -> None:
+        while self.event_batch:
+            batch, self.event_batch = self.event_batch, []
+            self.writing_chunks = {chunk_index for chunk_index, _ in batch}
+            chunk_of = {
+                (linked["dialog_id"], linked["event"].get('message_id')): chunk_index
+                for chunk_index, linked in batch
+            }
+            try:
+                rows = await self.create_events([linked for _, linked in batch])
+                for row in rows:
+                    self.event_rows.setdefault(chunk_of[(row["dialog_id"], row["event_id"])], []).append(row)
+            except Exception as e:
+                # Raised by take() of the chunks involved
+                self.event_error = e
+            finally:
+                self.writing_chunks = set()
+                async with self.events_written:
+                    self.events_written.notify_all()
+
+    def _writing(self, chunk_index: int) -> bool:
+        return chunk_index in self.writing_chunks or any(index == chunk_index for index, _ in self.event_batch)
+
+    async def create_events(self, linked_events: List[dict]) -> List[dict]:
+        async with self.event_lock:
+            rows = await self.message_service.create_events(linked_events, self.pending_events)
+            self.pending_events.extend(rows)
+            return rows
+
+    async def take(self, chunk_index: int) -> Tuple[Dict[MessageKey, Optional[str]], Set[MessageKey], List[dict]]:
+        """
+        Returns what was dispatched for a chunk: the submitted forwards, the
+        message keys whose events were handled and the calendar rows created.
+        """
+        async with self.events_written:
+            await self.events_written.wait_for(lambda: not self._writing(chunk_index))
+        if self.event_error is not None:
+            error, self.event_error = self.event_error, None
+            raise error
+        # Results of a stream that ended without closing the array
+        self.submit_results(chunk_index)
+        submitted = self.submitted.pop(chunk_index, {})
+        return submitted, self.event_keys.pop(chunk_index, set()), self.event_rows.pop(chunk_index, [])
+
+    def committed(self, rows: List[dict]) -> None:
+        committed_ids = {id(row) for row in rows}
+        self.pending_events = [row for row in self.pending_events if id(row) not in committed_ids]
+
+    def cancel(self) -> None:
+        if self.event_writer is not None:
+            self.event_writer.cancel()
@@ -0,0 +1,77 @@
+import json
+from typing import List, Optional, Tuple
+
+
+class StreamingResultParser:
+    """
+    Incremental scanner for the analyzer's JSON answer. Text is fed as it
+    streams in, and every object of a top-level array (results, Events) is
+    returned as soon as its closing brace arrives, followed by (key, None)
+    once the array itself is closed. Anything around the top-level object,
+    such as code fences, is ignored. The complete answer is still parsed as a
+    whole once the stream ends.
+    """
+
+    def __init__(self, keys=("results", "Events")):
+        self.keys = set(keys)
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = None
+        self.last_string = None
+        self.current_key = None
+        self.array_key = None
+        self.item_start = None
+
+    def feed(self, text: str) -> List[Tuple[str, Optional[dict]]]:
+        """
+        Adds streamed text and returns the (key, item) pairs completed by it.
+        """
+        self.buffer += text
+        items = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 1:
+                        self.last_string = self.buffer[self.string_start + 1:self.position]
+            elif char == '"':
+                if self.depth > 0:
+                    self.in_string = True
+                    self.string_start = self.position
+            elif char == ":" and self.depth == 1:
+                self.current_key = self.last_string
+            elif char in "{[":
+                self.depth += 1
+                if char == "[" and self.depth == 2:
+                    self.array_key = self.current_key
+                elif char == "{" and self.depth == 3 and self.array_key in self.keys:
+                    self.item_start = self.position
+            elif char in "}]":
+                if char == "}" and self.depth == 3 and self.item_start is not None:
+                    item = self._load(self.buffer[self.item_start:self.position + 1])
+                    if item is not None:
+                        items.append((self.array_key, item))
+                    self.item_start = None
+                elif char == "]" and self.depth == 2:
+                    if self.array_key in self.keys:
+                        items.append((self.array_key, None))
+                    self.array_key = None
+                self.depth = max(0, self.depth - 1)
+            self.position += 1
+        return items
+
+    @staticmethod
+    def _load(text: str) -> Optional[dict]:
+        try:
+            item = json.loads(text)
+        except json.JSONDecodeError:
+            return None
+        return item if isinstance(item, dict) else None
@@ -1,85 +1,255 @@
-from openai import OpenAI
-import time
+import asyncio
 import sys
 import json
-import os
-from datetime import datetime
-from tenacity import retry, stop_after_attempt, wait_fixed
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+from service.runMetrics import RunMetrics
+from service.streamingResultParser import StreamingResultParser
+
+RESPONSE_SCHEMA = {
+    "name": "message_analysis",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "required": ["found", "results", "Events"],
+        "properties": {
+            "found": {"type": "boolean"},
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "required": ["chat_id", "message_id", "text"],
+                    "properties": {
+                        "chat_id": {"type": "string"},
+                        "message_id": {"type": "string"},
+                        "text": {"type": "string"}
+                    },
+                    "additionalProperties": False
+                }
+            },
+            "Events": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "required": ["chat_id", "message_id", "start_datetime", "end_datetime", "title", "description"],
+                    "properties": {
+                        "chat_id": {"type": "string"},
+                        "message_id": {"type": "string"},
+                        "start_datetime": {"type": "string"},
+                        "end_datetime": {"type": "string"},
+                        "title": {"type": "string"},
+                        "description": {"type": "string"}
+                    },
+                    "additionalProperties": False
+                }
+            }
+        },
+        "additionalProperties": False
+    }
+}
+
+MAX_RETRY_AFTER_SECONDS = 300
+
+# Models OpenRouter only caches a prompt prefix for when it is marked with
+# cache_control; OpenAI, DeepSeek and others cache long prefixes on their own
+CACHE_CONTROL_MODEL_PREFIXES = ("anthropic/", "google/gemini")
+
+
+def retry_after_seconds(exception):
+    """
+    Returns the delay requested by the Retry-After(-Ms) header of a failed
+    API response, or None if the error carries no such hint.
+    """
+    response = getattr(exception, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def wait_retry_after(fallback):
+    """
+    Tenacity wait strategy honouring Retry-After on 429/503 responses and
+    using the fallback strategy for any other error.
+    """
+    def wait(retry_state):
+        delay = retry_after_seconds(retry_state.outcome.exception())
+        if delay is not None:
+            return min(delay, MAX_RETRY_AFTER_SECONDS)
+        return fallback(retry_state)
+    return wait
+
 
 class TextAnalyzer:
-    def __init__(self, key, base_prompt, model):
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=key,
-        )
+    def __init__(
+        self,
+        key,
+        base_prompt,
+        model,
+        max_concurrency=4,
+        cache=None,
+        metrics=None,
+        base_url="https://openrouter.ai/api/v1",
+        streaming=False,
+    ):
+        self.key = key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self._client = None
         self.model = model
         self.base_prompt = base_prompt
+        # Built once, so every request starts with the same bytes and providers
+        # can serve the prefix from their prompt cache
+        self.system_message = self.build_system_message(base_prompt, model)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache = cache
+        self.metrics = metrics or RunMetrics()
+        # Stream completions and hand over results and events as they complete
+        self.streaming = streaming
 
-    @retry(stop=stop_after_attempt(10), wait=wait_fixed(30))
-    def __generate_content_with_retry(self, client, model, base_prompt, text):
-        response_schema = {
-            "name": "message_analysis",
-            "strict": True,
-            "schema": {
-                "type": "object",
-                "required": ["found", "results", "Events"],
-                "properties": {
-                    "found": {"type": "boolean"},
-                    "results": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "required": ["chat_id", "message_id", "text"],
-                            "properties": {
-                                "chat_id": {"type": "string"},
-                                "message_id": {"type": "string"},
-                                "text": {"type": "string"}
-                            },
-                            "additionalProperties": False
-                        }
-                    },
-                    "Events": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "required": ["chat_id", "message_id", "start_datetime", "end_datetime", "title", "description"],
-                            "properties": {
-                                "chat_id": {"type": "string"},
-                                "message_id": {"type": "string"},
-                                "start_datetime": {"type": "string"},
-                                "end_datetime": {"type": "string"},
-                                "title": {"type": "string"},
-                                "description": {"type": "string"}
-                            },
-                            "additionalProperties": False
-                        }
-                    }
-                },
-                "additionalProperties": False
+    @property
+    def client(self):
+        """
+        The API client, built on first use so that runs answered from the cache
+        never import openai and httpx.
+        """
+        if self._client is None:
+            with self.metrics.time("llm_client_init"):
+                import httpx
+                from openai import AsyncOpenAI
+                # One pooled HTTP client shared by all requests; retries are handled
+                # below so the SDK's own retry loop is disabled.
+                http_client = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency
+                    ),
+                    timeout=httpx.Timeout(300, connect=10),
+                )
+                self._client = AsyncOpenAI(
+                    base_url=self.base_url,
+                    api_key=self.key,
+                    http_client=http_client,
+                    max_retries=0,
+                )
+        return self._client
+
+    @staticmethod
+    def build_system_message(base_prompt, model) -> dict:
+        if model.startswith(CACHE_CONTROL_MODEL_PREFIXES):
+            return {
+                "role": "system",
+                "content": [{"type": "text", "text": base_prompt, "cache_control": {"type": "ephemeral"}}],
             }
-        }
+        return {"role": "system", "content": base_prompt}
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+    @retry(
+        stop=stop_after_attempt(10),
+        wait=wait_retry_after(wait_random_exponential(multiplier=2, max=60)),
+        before_sleep=RunMetrics.count_retries("llm"),
+    )
+    async def __generate_content_with_retry(self, client, model, text):
+        # Only the request itself holds a slot, not the backoff sleep
+        async with self.semaphore:
+            started = time.monotonic()
+            completion = await client.chat.completions.create(**self.__request_options(model, text))
+            elapsed = time.monotonic() - started
+        self.__record_request(elapsed, getattr(completion, "usage", None))
+        return completion
+
+    @retry(
+        stop=stop_after_attempt(10),
+        wait=wait_retry_after(wait_random_exponential(multiplier=2, max=60)),
+        before_sleep=RunMetrics.count_retries("llm"),
+    )
+    async def __stream_content_with_retry(self, client, model, text, on_item):
+        """
+        Streams the completion and awaits on_item(key, item) for every results
+        or Events item as soon as it is complete, and on_item(key, None) when
+        the array is closed; returns the whole content. A retried stream hands
+        over its items again, so on_item must ignore repeats.
+        """
+        parser = StreamingResultParser()
+        parts = []
+        usage = None
+        first_item_at = None
+        async with self.semaphore:
+            started = time.monotonic()
+            stream = await client.chat.completions.create(
+                stream=True, **self.__request_options(model, text)
+            )
+            async for chunk in stream:
+                # OpenRouter sends usage with the last chunk, which has no choices
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                for key, item in parser.feed(delta):
+                    if first_item_at is None and item is not None:
+                        first_item_at = time.monotonic()
+                        self.metrics.observe("llm_first_item", first_item_at - started)
+                    await on_item(key, item)
+            elapsed = time.monotonic() - started
+        self.__record_request(elapsed, usage)
+        return "".join(parts)
 
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": base_prompt},
+    def __request_options(self, model, text) -> dict:
+        # Only the user message changes between requests
+        return {
+            "model": model,
+            "messages": [
+                self.system_message,
                 {"role": "user", "content": text}
             ],
-            response_format={
+            "response_format": {
                 "type": "json_schema",
-                "json_schema": response_schema
+                "json_schema": RESPONSE_SCHEMA
             },
-            temperature=0,
-        )
-        return completion
+            "temperature": 0,
+            # Asks OpenRouter to include the request cost in usage
+            "extra_body": {"usage": {"include": True}},
+        }
 
-    def __checkMessages(self, text):
+    def __record_request(self, elapsed, usage) -> None:
+        prompt_cache = "hit" if RunMetrics.cached_prompt_tokens(usage) else "miss"
+        self.metrics.observe("llm_request", elapsed, prompt_cache=prompt_cache)
+        self.metrics.record_usage(usage)
+
+    async def __checkMessages(self, text, on_item=None):
         response = None
         try:
-            response = self.__generate_content_with_retry(self.client, self.model, self.base_prompt, text)
+            if on_item is not None:
+                response = await self.__stream_content_with_retry(self.client, self.model, text, on_item)
+            else:
+                response = await self.__generate_content_with_retry(self.client, self.model, text)
         except Exception as e:
-            # Code 429 logic might be different with OpenAI lib (usually APIConnectionError or RateLimitError)
-            # Keeping generic exception logging for now but checking for status_code if available
+            # 429s and other API errors have already been retried above
             sys.stderr.write("{}: Failed to get response: {}\n".format(datetime.now(), e))
             
         if response is None:
@@ -95,21 +265,38 @@ class TextAnalyzer:
             content = content[:-3]
         return content.strip()
 
-    def findMessages(self, text):
-        response = self.__checkMessages(text)
-        
+    async def findMessages(self, text, on_item=None):
+        """
+        Returns the found results and Events, or None. In streaming mode,
+        on_item(key, item) is also awaited for each item while the completion
+        streams in.
+        """
+        if not self.streaming:
+            on_item = None
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(self.base_prompt, self.model, RESPONSE_SCHEMA, text)
+            hit, cached = self.cache.get(cache_key)
+            self.metrics.increment("llm_cache_lookups", result="hit" if hit else "miss")
+            if hit:
+                return cached
+        self.metrics.increment("llm_payload_bytes", len(text.encode("utf-8")))
+
+        response = await self.__checkMessages(text, on_item)
+
         try:
-            content = response.choices[0].message.content
+            content = response if on_item is not None else response.choices[0].message.content
             content = self.__clean_json_content(content)
             parsed = json.loads(content)
         except (AttributeError, IndexError, json.JSONDecodeError) as e:
              sys.stderr.write("{}: Failed to parse response: {}\n".format(datetime.now(), e))
+             self.metrics.increment("llm_parse_failures")
              return None
 
-        if not parsed.get('found'):
-            return None 
-        
-        print("Messages found in: {}".format(text))
-        results = parsed.get('results', [])
-        events = parsed.get('Events', [])
-        return {"results": results, "Events": events}
\ No newline at end of file
+        result = None
+        if parsed.get('found'):
+            print("Messages found in: {}".format(text))
+            result = {"results": parsed.get('results', []), "Events": parsed.get('Events', [])}
+        if cache_key is not None:
+            self.cache.put(cache_key, result)
+        return result
\ No newline at end of file
@@ -1,49 +1,57 @@
 from zoneinfo import ZoneInfo
-from telethon import TelegramClient
-from telethon.tl.types import Message, PeerChannel, PeerUser, Chat
-from datetime import timedelta
-import asyncio
+from telethon.tl.types import Message
+from telethon.errors import FloodWaitError
+from telethon.utils import get_peer_id
+from typing import Optional
+from model.chatEntity import ChatEntity
+import hashlib
 
 class Util:
 
-    _offset = 0
-
     @staticmethod
-    def get_message_link(message: Message):
-        if isinstance(message.chat, Chat):
-            return 'From chat: {}'.format(message.chat.title)
-        if (hasattr(message.chat, 'has_link') and message.chat.has_link and message.chat.username is not None):
-            return 'https://t.me/{}/{}'.format(message.chat.username, message.id)
-        else:
-            return 'https://t.me/c/{}/{}'.format(message.chat.id, message.id)
+    def wait_flood_aware(default_wait: float):
+        """
+        Tenacity wait strategy: sleeps for as long as Telegram asks on FloodWaitError,
+        otherwise for default_wait seconds.
+        """
+        def wait(retry_state):
+            return Util.flood_wait_seconds(retry_state.outcome.exception(), default_wait)
+        return wait
 
     @staticmethod
-    async def send_message_report(client: TelegramClient, message: Message, output_dialog_id: int):
-        if (message is None):
-            return None
-        
-        message_link = Util.get_message_link(message)
+    def flood_wait_seconds(exception: Exception, default_wait: float) -> float:
+        if isinstance(exception, FloodWaitError):
+            return exception.seconds + 1
+        return default_wait
 
-        # Send message with delay to mark as unread
-        await client.send_message(
-            PeerChannel(output_dialog_id), 
-            message_link, 
-            link_preview=False, 
-            schedule=timedelta(seconds=60 + Util._offset * 60)
-            )
-        await client.forward_messages(
-            PeerChannel(output_dialog_id), 
-            message, 
-            schedule=timedelta(seconds=90 + Util._offset * 60)
-            )
+    @staticmethod
+    def chat_id(message: Message) -> int:
+        """
+        Unmarked id of the message's chat, the id Dialog uses, read from the
+        message itself so it works whether or not message.chat is loaded.
+        """
+        return get_peer_id(message.peer_id, add_mark=False)
 
-        Util._offset += 1
+    @staticmethod
+    def get_message_link(message: Message, chat: Optional[ChatEntity] = None):
+        """
+        chat is the cached metadata of the message's chat (see EntityCache);
+        without it message.chat is used.
+        """
+        chat = chat or ChatEntity.from_entity(message.chat)
+        if chat.type == ChatEntity.CHAT:
+            return 'From chat: {}'.format(chat.title)
+        if chat.has_link and chat.username is not None:
+            return 'https://t.me/{}/{}'.format(chat.username, message.id)
+        else:
+            return 'https://t.me/c/{}/{}'.format(chat.chat_id, message.id)
 
     @staticmethod
-    def construct_message_object(message: Message):
+    def construct_message_object(message: Message, chat: Optional[ChatEntity] = None):
+        chat = chat or ChatEntity.from_entity(message.chat)
         return {
-            'chat_title': message.chat.title,
-            'chat_id': message.chat.id,
+            'chat_title': chat.title,
+            'chat_id': chat.chat_id,
             'text': Util.construct_message_text(message),
             'message_id': message.id,
             'datetime': message.date.astimezone(ZoneInfo("Europe/Madrid")).isoformat(),
@@ -64,17 +72,20 @@ class Util:
             return ""
 
     @staticmethod
-    def is_message_in_list(str1: str, str_list: list) -> bool:
+    def normalize_letters(text: str) -> str:
+        return ''.join(filter(str.isalpha, text.replace('\n', ''))).lower()
+
+    @staticmethod
+    def message_fingerprint(text: Optional[str]) -> Optional[str]:
         """
-        Returns True if str1 matches any string in str_list,
-        comparing only letters and ignoring newlines and case.
+        Hash of the letters-only, lower-cased text, so messages that differ only
+        in punctuation, digits or line breaks share a fingerprint. Returns None
+        for text without letters, which cannot be told apart this way.
         """
-        str1_clean = ''.join(filter(str.isalpha, str1.replace('\n', ''))).lower()
-        for s in str_list:
-            s_clean = ''.join(filter(str.isalpha, s.replace('\n', ''))).lower()
-            if str1_clean == s_clean:
-                return True
-        return False
+        normalized = Util.normalize_letters(text or '')
+        if not normalized:
+            return None
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()
 
 
 